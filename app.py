@@ -1,257 +1,494 @@
 # app.py
-from flask import Flask, request, jsonify
+from dotenv import load_dotenv
+# Load .env before anything in scripts/ reads its settings at import time.
+load_dotenv()
+
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, g
 from flask_cors import CORS
-from pydantic import BaseModel
-from typing import List
 from scripts.csv_db import ( 
     create_user, get_user_by_id, get_user_by_email,
     update_user_preferences, get_preferences_by_user_id,
-    create_shopping_session, get_shopping_session, get_shopping_sessions_by_user_id, add_product_page
+    create_shopping_session, get_shopping_session, get_shopping_sessions_by_user_id,
+    iter_shopping_sessions_by_user_id, add_product_page, invalidate_comparison,
+    end_shopping_session
+)
+from scripts.assistant_helpers import create_chat_thread
+from scripts import services
+from scripts.admission import Overloaded, admission_controlled, get_limiter
+from scripts.auth import InvalidToken, bearer_token, issue_token, verify_token
+from scripts.archiver import start_archiver
+from scripts.background import background_tasks
+from scripts.single_flight import in_flight, input_hash
+from scripts.product_index import page_source_hash, product_index
+from scripts.logging_utils import get_logger, fields
+from scripts.metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, HTTP_LATENCY, HTTP_REQUESTS, render_metrics
 )
-from scripts.assistant_helpers import create_chat_thread, ChatAgent, ProductDescriptionAgent, ComparisonAgent
-import openai
+from scripts.http_cache import compress_response, conditional_json
+from scripts.tracing import (
+    finish_trace, profile_sampler, span, start_trace, trace_header_value, write_trace, TRACE_HEADER
+)
+from itertools import islice
+import hmac
+import json
 import os
+import time
 
-from dotenv import load_dotenv
-load_dotenv()
+# When "1", /end schedules preference extraction in the background and returns 202.
+END_SESSION_ASYNC = os.getenv("END_SESSION_ASYNC", "1") == "1"
+# Upper bound for the `limit` query parameter of paginated endpoints.
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+# Required in the X-Admin-Token header of /api/admin/* requests. Admin routes are disabled when unset.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# When "1", user and session endpoints reject requests without a valid bearer token.
+# Tokens that are sent are always checked, whatever this is set to.
+AUTH_REQUIRED = os.getenv("AUTH_REQUIRED", "0") == "1"
+
+log = get_logger("app")
+
+# The OpenAI client and the agents are built on first use by scripts/services.py,
+# so importing this module (and forking gunicorn workers from it) stays cheap.
+api = Blueprint("api", __name__)
+
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace, g.trace_token = start_trace(f"{request.method} {endpoint}")
+    g.profiler = profile_sampler.start(endpoint)
+
+def authenticate_request():
+    """
+    Verifies the bearer token, if any, and checks that the caller owns the user
+    or session named in the URL. Verification only needs the signing secret;
+    the users table is never read.
+    """
+    g.user_id = None
+    token = bearer_token(request.headers.get("Authorization"))
+    if token is not None:
+        try:
+            g.user_id = verify_token(token)
+        except InvalidToken as e:
+            return jsonify({"error": f"Invalid token: {e}"}), 401
+
+    view_args = request.view_args or {}
+    if "user_id" not in view_args and "session_id" not in view_args:
+        return None
+    if g.user_id is None:
+        if AUTH_REQUIRED:
+            return jsonify({"error": "Authentication required"}), 401
+        return None
+
+    owner = view_args.get("user_id")
+    if owner is None:
+        with span("load_session"):
+            session = get_shopping_session(view_args["session_id"])
+        if session is None:
+            return None  # let the endpoint answer 404
+        owner = session.get("user_id")
+    if owner != g.user_id:
+        return jsonify({"error": "Forbidden"}), 403
+    return None
+
+def record_request(response):
+    duration = time.perf_counter() - g.get("request_start", time.perf_counter())
+    # Label by route template (e.g. /api/users/<user_id>) to keep label cardinality bounded.
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
 
-MAIN_ASSIST_ID = os.getenv('MAIN_CHAT_ASSIST_ID')
-DESCRIPT_ASSIST_ID = os.getenv('DESCRIPT_ASSIST_ID')
-COMPARE_ASSIST_ID = os.getenv('COMPARE_ASSIST_ID')
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY_PERS", "")
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        path = profile_sampler.stop(profiler, endpoint)
+        log.info("Request profile written", extra=fields(endpoint=endpoint, path=path))
 
-print("Creating OpenAI Client")
-openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
-print("Client Created")
+    token = g.pop("trace_token", None)
+    if token is not None:
+        trace = finish_trace(token)
+        write_trace(trace)
+        if TRACE_HEADER or request.headers.get("X-Debug-Trace") == "1":
+            response.headers["X-Trace"] = trace_header_value(trace)
 
-# Create the agent objects once on startup.
-chat_agent = ChatAgent(openai_client, MAIN_ASSIST_ID)
-product_description_agent = ProductDescriptionAgent(openai_client, DESCRIPT_ASSIST_ID)
-compare_agent = ComparisonAgent(openai_client, COMPARE_ASSIST_ID)
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    HTTP_LATENCY.observe(duration, endpoint=endpoint, method=request.method)
 
-app = Flask(__name__)
-CORS(app)
+    # One access log line per request; bodies are only logged at DEBUG level.
+    log.info("Request handled", extra=fields(
+        method=request.method,
+        path=request.path,
+        status=response.status_code,
+        duration_ms=round(duration * 1000, 2),
+    ))
+    return response
 
-@app.route('/api/users', methods=['POST'])
+def cleanup_request(exc):
+    # after_request is skipped when a request fails hard; make sure the profiler
+    # lock is released and the trace is detached from this worker thread.
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profile_sampler.stop(profiler, request.url_rule.rule if request.url_rule else "unmatched")
+    token = g.pop("trace_token", None)
+    if token is not None:
+        finish_trace(token)
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+def is_admin_request():
+    supplied = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(supplied, ADMIN_TOKEN)
+
+@api.route('/api/admin/profile', methods=['GET', 'POST'])
+def api_admin_profile():
+    """
+    GET returns the armed endpoints and the profiles dumped so far.
+    POST {"endpoint": "/api/shopping_sessions/<session_id>/product_comparison", "count": 5}
+    profiles the next `count` requests to that route (count 0 disarms it).
+    """
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    if request.method == 'POST':
+        data = request.json or {}
+        endpoint = data.get("endpoint")
+        if not endpoint:
+            return jsonify({"error": "Missing endpoint"}), 400
+        profile_sampler.arm(endpoint, int(data.get("count", 1)))
+        log.info("Profiling armed", extra=fields(endpoint=endpoint, count=data.get("count", 1)))
+    return jsonify(profile_sampler.status()), 200
+
+@api.route('/api/users', methods=['POST'])
 def api_create_user():
-    print("Received request: POST /api/users")
     data = request.json
-    print("Data received:", data)
+    log.debug("Received request: POST /api/users", extra=fields(data=data))
     name = data.get('name')
     email = data.get('email')
     password = data.get('password')
     new_user = create_user(name, email, password)
-    print("User created:", new_user)
+    log.info("User created", extra=fields(user_id=new_user["user_id"]))
     return jsonify(new_user), 201
 
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
 def api_login():
-    print("Received request: POST /api/login")
     data = request.json
-    print("Data received:", data)
+    log.debug("Received request: POST /api/login", extra=fields(data=data))
     email = data.get("email")
     password = data.get("password")
     # Use the helper function to retrieve a user by email.
     user = get_user_by_email(email)
     if not user or user.get("password") != password:
-        print("Invalid login attempt for email:", email)
+        log.warning("Invalid login attempt", extra=fields(email=email))
         return jsonify({"error": "Invalid email or password"}), 401
-    print("Login successful for user:", user)
-    return jsonify(user), 200
+    log.info("Login successful", extra=fields(user_id=user["user_id"]))
+    token, expires_at = issue_token(user["user_id"])
+    return jsonify({**user, "token": token, "token_expires_at": expires_at}), 200
 
-@app.route('/api/users/<user_id>', methods=['GET'])
+@api.route('/api/users/<user_id>', methods=['GET'])
 def api_get_user(user_id):
-    print(f"Received request: GET /api/users/{user_id}")
     user = get_user_by_id(user_id)
     if user is None:
-        print("User not found for user_id:", user_id)
+        log.info("User not found", extra=fields(user_id=user_id))
         return jsonify({"error": "User not found"}), 404
-    print("Returning user:", user)
+    log.debug("Returning user", extra=fields(user=user))
     return jsonify(user), 200
 
-@app.route('/api/users/<user_id>/preferences', methods=['POST'])
+@api.route('/api/users/<user_id>/preferences', methods=['POST'])
 def api_set_preferences(user_id):
-    print(f"Received request: POST /api/users/{user_id}/preferences")
     data = request.json
-    print("Preferences data received:", data)
+    log.debug("Preferences data received", extra=fields(user_id=user_id, data=data))
     prefs_list = data.get('preferences', [])
     updated = update_user_preferences(user_id, prefs_list)
-    print("Updated preferences for user", user_id, ":", updated)
+    log.info("Updated preferences", extra=fields(user_id=user_id, count=len(updated)))
     return jsonify({
         "message": "Preferences updated",
         "updated_preferences": updated
     }), 200
 
-@app.route('/api/users/<user_id>/preferences', methods=['GET'])
+@api.route('/api/users/<user_id>/preferences', methods=['GET'])
 def api_get_preferences(user_id):
-    print(f"Received request: GET /api/users/{user_id}/preferences")
     prefs = get_preferences_by_user_id(user_id)
-    print("Returning preferences for user", user_id, ":", prefs)
-    return jsonify({"user_id": user_id, "preferences": prefs}), 200
+    log.debug("Returning preferences", extra=fields(user_id=user_id, preferences=prefs))
+    return conditional_json({"user_id": user_id, "preferences": prefs})
 
-@app.route('/api/users/<user_id>/shopping_sessions', methods=['POST'])
+@api.route('/api/users/<user_id>/shopping_sessions', methods=['POST'])
 def api_create_session(user_id):
-    print(f"Received request: POST /api/users/{user_id}/shopping_sessions")
     data = request.json
-    print("Session creation data:", data)
+    log.debug("Session creation data", extra=fields(user_id=user_id, data=data))
     intent = data.get("intent", "")
     
     # Retrieve the user from CSV.
     user = get_user_by_id(user_id)
     if not user:
-        print("User not found for shopping session, user_id:", user_id)
+        log.info("User not found for shopping session", extra=fields(user_id=user_id))
         return jsonify({"error": "User not found"}), 404
 
     user_preferences = get_preferences_by_user_id(user_id)
-    print("User preferences:", user_preferences)
     
-    # Create a new thread using the Assistants API.
-    print("Creating chat thread via Assistants API...")
-    thread_id, initial_messages = create_chat_thread(openai_client, user_preferences, intent)
-    print("Chat thread created with thread_id:", thread_id)
-    print("Initial messages:", initial_messages)
+    # Create the chat thread (on the Assistants API, or locally for the completions engine).
+    thread_id, initial_messages = create_chat_thread(
+        services.get_openai_client(), user_preferences, intent,
+        local=services.chat_engine() == "completions"
+    )
+    log.info("Chat thread created", extra=fields(user_id=user_id, thread_id=thread_id))
     
     # Save the new shopping session (with the thread_id) to CSV.
     new_session = create_shopping_session(user_id, intent, thread_id)
-    print("Shopping session created:", new_session)
+    log.info("Shopping session created", extra=fields(session_id=new_session["session_id"], user_id=user_id))
     
     return jsonify(new_session), 201
 
-@app.route('/api/users/<user_id>/sessions', methods=['GET'])
+@api.route('/api/users/<user_id>/sessions', methods=['GET'])
 def api_get_user_sessions(user_id):
-    print(f"Received request: GET /api/users/{user_id}/sessions")
-    sessions = get_shopping_sessions_by_user_id(user_id)
-    if not sessions:
-        print("No sessions found for user_id:", user_id)
+    """
+    Query parameters (all optional):
+      limit         page size (1..MAX_PAGE_SIZE); when more sessions remain, the
+                    cursor for the next page is returned in the X-Next-Cursor header.
+      after         cursor: only sessions with a larger session_id.
+      created_from  inclusive lower bound on created_at (ISO date or datetime).
+      created_to    inclusive upper bound on created_at.
+      intent        case-insensitive substring filter on the intent.
+      stream        "1" streams the JSON array row by row instead of building it in memory.
+      archived      "0" leaves out archived sessions (included by default).
+    """
+    args = request.args
+    filters = {
+        "after": args.get("after") or None,
+        "created_from": args.get("created_from") or None,
+        "created_to": args.get("created_to") or None,
+        "intent": args.get("intent") or None,
+    }
+    try:
+        limit = int(args["limit"]) if args.get("limit") else None
+        if filters["after"] is not None:
+            int(filters["after"])
+    except ValueError:
+        return jsonify({"error": "limit and after must be integers"}), 400
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+    include_archived = args.get("archived") != "0"
+
+    if args.get("stream") == "1":
+        sessions = iter_shopping_sessions_by_user_id(user_id, include_archived=include_archived, **filters)
+        if limit is not None:
+            sessions = islice(sessions, limit)
+
+        def generate():
+            yield "["
+            for i, session in enumerate(sessions):
+                yield ("," if i else "") + json.dumps(session)
+            yield "]"
+
+        return current_app.response_class(generate(), mimetype="application/json")
+
+    # Fetch one extra row to know whether another page follows.
+    sessions = get_shopping_sessions_by_user_id(
+        user_id, limit=limit + 1 if limit is not None else None, include_archived=include_archived, **filters
+    )
+    has_more = limit is not None and len(sessions) > limit
+    sessions = sessions[:limit] if limit is not None else sessions
+
+    if not sessions and not any(filters.values()):
+        log.info("No sessions found", extra=fields(user_id=user_id))
         return jsonify({"error": "No sessions found for this user"}), 404
-    print("Returning sessions for user_id:", user_id, sessions)
-    return jsonify(sessions), 200
+    log.debug("Returning sessions", extra=fields(user_id=user_id, count=len(sessions)))
+    response = conditional_json(sessions)
+    if has_more:
+        response.headers["X-Next-Cursor"] = sessions[-1]["session_id"]
+    return response
 
-@app.route('/api/shopping_sessions/<session_id>', methods=['GET'])
+@api.route('/api/shopping_sessions/<session_id>', methods=['GET'])
 def api_get_session(session_id):
-    print(f"Received request: GET /api/shopping_sessions/{session_id}")
     session = get_shopping_session(session_id)
     if not session:
-        print("Session not found for session_id:", session_id)
+        log.info("Session not found", extra=fields(session_id=session_id))
         return jsonify({"error": "Session not found"}), 404
-    print("Returning shopping session:", session)
-    return jsonify(session), 200
+    log.debug("Returning shopping session", extra=fields(session=session))
+    return conditional_json(session)
 
-@app.route('/api/shopping_sessions/<session_id>/messages', methods=['POST'])
+@api.route('/api/shopping_sessions/<session_id>/messages', methods=['POST'])
+@admission_controlled("chat")
 def api_add_message(session_id):
     data = request.json
     user_message = data.get("message", "")
     
-    session = get_shopping_session(session_id)
+    with span("load_session"):
+        session = get_shopping_session(session_id)
     if not session:
         return jsonify({"error": "Session not found"}), 404
     
     thread_id = session.get("thread_id")
-    updated_messages = chat_agent.add_message(thread_id, user_message)
+    try:
+        updated_messages = services.get_chat_agent().add_message(thread_id, user_message)
+    finally:
+        # The transcript changed, so a cached comparison is stale.
+        invalidate_comparison(session_id)
     return jsonify(updated_messages), 200
 
-@app.route('/api/shopping_sessions/<session_id>/product_description', methods=['POST'])
+@api.route('/api/shopping_sessions/<session_id>/product_description', methods=['POST'])
 def api_generate_product_description(session_id):
     data = request.json
     product_page = data.get("product_page", "")
     if not product_page:
         return jsonify({"error": "Missing product_page string"}), 400
-    
-    
-    result = product_description_agent.generate_description(session_id, product_page)
 
-    # Save the product page description to the product pages CSV
-    add_product_page(session_id, result[0]['content'])
+    agent = services.get_product_description_agent()
+
+    def describe():
+        # A reused description costs no OpenAI call, so it neither queues for
+        # nor is rejected by the admission limit.
+        result = agent.find_reusable(session_id, product_page)
+        if result is None:
+            with get_limiter("description").slot():
+                result = agent.generate_description(session_id, product_page)
+        # Save the product page description to the product pages CSV, unless it
+        # is this session's own earlier description of the same page.
+        if result[0].get("reused_from") != session_id:
+            with span("save_product_page"):
+                add_product_page(session_id, result[0]['content'], page_source_hash(product_page))
+        return result
+
+    # A retried or double-submitted page joins the run already in progress
+    # (and is saved once) instead of starting a second one.
+    result = in_flight.do(("product_description", session_id, input_hash(product_page)), describe)
     return jsonify(result), 200
 
-@app.route('/api/shopping_sessions/<session_id>/product_comparison', methods=['POST'])
+@api.route('/api/shopping_sessions/<session_id>/product_comparison', methods=['POST'])
 def api_generate_product_comparison(session_id):
-    
-    result = compare_agent.generate_comparison(session_id)
+
+    agent = services.get_comparison_agent()
+    # A cached comparison costs no OpenAI call, so it neither queues for nor is
+    # rejected by the admission limit.
+    cached = agent.cached_comparison(session_id)
+    if cached is not None:
+        return jsonify(cached), 200
+
+    def compare():
+        with get_limiter("comparison").slot():
+            return agent.generate_comparison(session_id)
+
+    result = in_flight.do(("product_comparison", session_id, ""), compare)
     return jsonify(result), 200
 
 
-# Define our structured response model for extracting user preferences.
-class Preference(BaseModel):
-    key: str
-    value: str
+@api.route('/api/products/search', methods=['GET'])
+def api_search_products():
+    """
+    Full-text (BM25) search over the product descriptions of the caller's
+    sessions. Descriptions are tailored to their user's conversation, so a
+    bearer token is always required, whatever AUTH_REQUIRED says.
 
-class PreferenceExtraction(BaseModel):
-    preferences: List[Preference]
+    Query parameters:
+      q      search text (required).
+      limit  number of results (1..50, default 10).
+    """
+    user_id = g.get("user_id")
+    if user_id is None:
+        return jsonify({"error": "Authentication required"}), 401
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"error": "Missing q"}), 400
+    try:
+        limit = int(request.args.get("limit", "10"))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    if not 1 <= limit <= 50:
+        return jsonify({"error": "limit must be between 1 and 50"}), 400
 
-@app.route('/api/shopping_sessions/<session_id>/end', methods=['POST'])
+    with span("product_index_search"):
+        session_ids = [s["session_id"] for s in iter_shopping_sessions_by_user_id(user_id)]
+        hits = product_index.search(query, limit=limit, session_ids=session_ids)
+    results = []
+    for score, record in hits:
+        lines = [line.strip(" #*") for line in record["product_page"].splitlines() if line.strip(" #*")]
+        results.append({
+            "session_id": record["session_id"],
+            "score": score,
+            "title": lines[0] if lines else "",
+            "snippet": " ".join(lines[1:])[:300],
+        })
+    return conditional_json({"query": query, "results": results})
+
+@api.route('/api/shopping_sessions/<session_id>/end', methods=['POST'])
 def api_end_shopping_session(session_id):
     """
     Ends a shopping session by analyzing the user's conversation and extracting
     user preferences/insights to update the preferences table for future use.
     
     This endpoint performs the following steps:
-      1. Retrieve the shopping session using the session_id.
-      2. Get the conversation (chat thread) associated with that session.
-      3. Use the Chat Completions API with structured response extraction (using a Pydantic model)
-         to extract key user preferences from the conversation.
-      4. Call update_user_preferences to update the user's preferences.
-      5. Return the updated preferences.
+      1. Retrieve the shopping session using the session_id and mark it ended
+         (ended_at), which makes it eligible for archiving after
+         ARCHIVE_AFTER_DAYS.
+      2. Hand the session to the PreferenceExtractionAgent, which only reads the
+         thread messages added since the last extraction, extracts preferences
+         with structured output and merges them into the user's preferences.
+      3. By default the extraction runs in the background and the endpoint
+         returns 202 immediately. With ?wait=1 (or END_SESSION_ASYNC=0) it runs
+         inline and returns the newly extracted preferences.
     """
     
     # Retrieve the session and get its thread id.
-    session = get_shopping_session(session_id)
+    with span("load_session"):
+        session = get_shopping_session(session_id)
     if not session:
         return jsonify({"error": "Session not found"}), 404
     thread_id = session.get("thread_id")
     if not thread_id:
         return jsonify({"error": "No thread associated with this session"}), 400
-    
-    # Fetch the conversation text from the thread.
-    conversation_response = openai_client.beta.threads.messages.list(thread_id=thread_id)
-    conversation_text = ""
-    for msg in conversation_response.data[::-1]:
-        for item in msg.content:
-            if item.type == "text":
-                conversation_text += item.text.value + "\n"
-
-    # Prepare the system prompt instructing extraction of user preferences.
-    system_prompt = (
-        "You are an expert at extracting structured user preferences from conversation text.\n "
-        "Given the conversation below, extract any key user preferences or insights.\n"
-        "Return your result following the provided structure.\n"
-        "Some examples of user information you might extract from a conversation:\n"
-        "{\n"
-        '  "preferences": [\n'
-        '    {"key": "Marital Status", "value": "Married"},\n'
-        '    {"key": "Career", "value": "Graphic Designer"},\n'
-        '    {"key": "Interests", "value": "Digital Design, Travel Documentaries, Baking"},\n'
-        '    {"key": "Tech Savviness", "value": "High"}\n'
-        "  ]\n"
-        "}\n\n"
-    )
-    
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": conversation_text}
-    ]
-    
-    # Use the structured data extraction feature with the Pydantic model.
-    extraction = openai_client.beta.chat.completions.parse(
-        model="gpt-4o",  # or another appropriate model version
-        messages=messages,
-        response_format=PreferenceExtraction
-    )
-    
-    # Extract the structured preferences from the parsed output.
-    extracted_prefs = extraction.choices[0].message.parsed
-    # Convert extracted preferences to the expected format for update_user_preferences
-    pref_list = [{"key": pref.key, "value": pref.value} for pref in extracted_prefs.preferences]
-    
-    user_id = session.get("user_id")
-    updated_preferences = update_user_preferences(user_id, pref_list)
-    
+    if not session.get("ended_at"):
+        session = end_shopping_session(session_id) or session
+
+    preference_agent = services.get_preference_agent()
+    limiter = get_limiter("extraction")
+    if END_SESSION_ASYNC and request.args.get("wait") != "1":
+        # Refuse up front when the extraction queue is full; otherwise the task
+        # waits for its slot on the background thread, not in this request.
+        # The client gets 202, so the task waits as long as it takes: it must
+        # not be dropped by the queue limit or timeout.
+        limiter.check()
+
+        def extract():
+            with limiter.slot(background=True):
+                return preference_agent.extract_preferences(session)
+        background_tasks.submit(f"extract:{session_id}", extract)
+        return jsonify({
+            "message": "Session ended. Preference extraction scheduled.",
+            "session_id": session_id
+        }), 202
+
+    with limiter.slot():
+        pref_list = preference_agent.extract_preferences(session)
     return jsonify({
         "message": "Session ended. Preferences updated.",
         "updated_preferences": pref_list
     }), 200
 
 
+def overloaded_response(exc):
+    response = jsonify({"error": "Server busy, retry later", "retry_after": exc.retry_after})
+    response.status_code = exc.status
+    response.headers["Retry-After"] = str(exc.retry_after)
+    return response
+
+def create_app():
+    """
+    Builds the Flask application. Used by `python app.py`, wsgi.py and gunicorn.
+    """
+    app = Flask(__name__)
+    # Browsers only let scripts read these response headers if they are exposed.
+    CORS(app, expose_headers=["X-Next-Cursor", "Retry-After"])
+    # after_request hooks run in reverse registration order: record_request
+    # sees the response before compression, so the access log and metrics
+    # are taken first and compression stays the last step.
+    app.after_request(compress_response)
+    app.before_request(start_request_timer)
+    # Starts this process's archiver thread on its first request (a no-op
+    # afterwards), so each forked worker gets its own.
+    app.before_request(start_archiver)
+    app.before_request(authenticate_request)
+    app.after_request(record_request)
+    app.teardown_request(cleanup_request)
+    app.register_error_handler(Overloaded, overloaded_response)
+    app.register_blueprint(api)
+    return app
+
+
 if __name__ == '__main__':
-    print("Starting Flask server...")
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    log.info("Starting Flask server")
+    create_app().run(debug=os.getenv("FLASK_DEBUG", "0") == "1", host='0.0.0.0', port=5000)
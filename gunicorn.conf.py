@@ -0,0 +1,40 @@
+# gunicorn.conf.py
+"""
+Production settings for `gunicorn -c gunicorn.conf.py wsgi:app`.
+
+Requests spend most of their time waiting on OpenAI (a run or a thread
+listing can take seconds), so each worker serves many requests from a pool of
+threads ("gthread") instead of one request per process.
+"""
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+# One process by default: the CSV tables, metrics, the profiler switch,
+# request coalescing and admission limits are all per process. Scale with
+# threads; raise GUNICORN_WORKERS only if you accept those limits.
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+if os.getenv("CSV_WRITE_BEHIND", "0") == "1":
+    # Write-behind keeps tables in process memory; several writers would overwrite each other.
+    workers = 1
+
+# Import the app once in the master and fork workers from it.
+preload_app = True
+# OpenAI runs are slow; don't let the arbiter kill a worker waiting on one.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then to bound memory growth.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = 200
+
+accesslog = None  # the app writes its own access log line per request
+
+
+def post_worker_init(worker):
+    # Build the OpenAI client and agents and read the tables before the worker
+    # takes traffic, so the first request does not pay for it.
+    from scripts import services
+    services.warm_up()
@@ -0,0 +1,225 @@
+# admission.py
+"""
+Admission control for the endpoints that call OpenAI.
+
+Each agent type gets a limiter with a fixed number of concurrent slots and a
+bounded FIFO wait queue. A request that finds the queue full is rejected at
+once with 429; a queued request that is not admitted within the queue timeout
+gets 503. Both carry a Retry-After estimate. Admitted requests only compete
+with `concurrency` others, so their latency stays close to the unloaded one.
+
+Limits are per process: with several gunicorn workers the effective limit is
+workers × concurrency.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from scripts.logging_utils import get_logger, fields
+from scripts.metrics import Counter, Gauge, Histogram, register
+
+log = get_logger("admission")
+
+# Defaults for every agent type; ADMISSION_<AGENT>_CONCURRENCY / _QUEUE /
+# _QUEUE_TIMEOUT override them per agent (e.g. ADMISSION_CHAT_CONCURRENCY=4).
+# A concurrency of 0 disables the limiter.
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "8"))
+ADMISSION_QUEUE = int(os.getenv("ADMISSION_QUEUE", "16"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "15"))
+
+ADMISSION_QUEUE_TIME = register(Histogram(
+    "admission_queue_seconds", "Time admitted requests waited for a slot, by agent.",
+    ("agent",),
+))
+ADMISSION_REJECTED = register(Counter(
+    "admission_rejected_total", "Requests turned away by admission control, by agent and reason.",
+    ("agent", "reason"),
+))
+ADMISSION_IN_FLIGHT = register(Gauge(
+    "admission_in_flight", "Requests currently holding a slot, by agent.",
+    ("agent",),
+))
+ADMISSION_QUEUED = register(Gauge(
+    "admission_queued", "Requests currently waiting for a slot, by agent.",
+    ("agent",),
+))
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is not admitted.
+
+    Attributes:
+        agent (str): The limiter that refused the request.
+        status (int): 429 when the queue was full, 503 when the wait timed out.
+        retry_after (int): Suggested seconds before retrying.
+    """
+    def __init__(self, agent, status, retry_after):
+        super().__init__(f"{agent} is overloaded")
+        self.agent = agent
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    """
+    Concurrency limiter with a bounded FIFO wait queue. A finishing request
+    hands its slot directly to the oldest waiter, so waiters are admitted in
+    arrival order.
+
+    Args:
+        name (str): Agent label used in metrics and errors.
+        concurrency (int): Slots; 0 admits everything.
+        queue_size (int): Maximum number of waiting requests.
+        queue_timeout (float): Seconds a request may wait before it gets 503.
+    """
+    def __init__(self, name, concurrency, queue_size, queue_timeout):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters = deque()
+        self._avg_service = None  # moving average of slot hold time, seconds
+
+    def _retry_after(self):
+        # Caller holds self._lock. Time for the queue ahead to drain, rounded up.
+        service = self._avg_service if self._avg_service is not None else 1.0
+        return max(1, math.ceil(service * (len(self._waiters) + 1) / self.concurrency))
+
+    def _reject(self, status, reason):
+        with self._lock:
+            retry_after = self._retry_after()
+        ADMISSION_REJECTED.inc(agent=self.name, reason=reason)
+        log.warning("Request rejected by admission control", extra=fields(
+            agent=self.name, reason=reason, retry_after=retry_after
+        ))
+        raise Overloaded(self.name, status, retry_after)
+
+    def check(self):
+        """
+        Raises Overloaded (429) if a request arriving now would be rejected,
+        without taking a slot. Used before handing work to a background thread.
+        """
+        if self.concurrency <= 0:
+            return
+        with self._lock:
+            full = self._active >= self.concurrency and len(self._waiters) >= self.queue_size
+        if full:
+            self._reject(429, "queue_full")
+
+    def acquire(self, background=False):
+        """
+        Takes a slot, waiting in the queue if needed.
+
+        Args:
+            background (bool): For work that was already accepted (checked
+                with check() and answered 202): wait in the queue even if it is
+                full and without the queue timeout, so the work is never dropped.
+                At most one background waiter per background thread is added.
+
+        Raises:
+            Overloaded: 429 if the queue is full, 503 if the wait timed out.
+        """
+        if self.concurrency <= 0:
+            return
+        start = time.perf_counter()
+        with self._lock:
+            if self._active < self.concurrency and not self._waiters:
+                self._active += 1
+                ADMISSION_IN_FLIGHT.inc(agent=self.name)
+                ADMISSION_QUEUE_TIME.observe(0.0, agent=self.name)
+                return
+            if len(self._waiters) >= self.queue_size and not background:
+                full = True
+            else:
+                full = False
+                ticket = threading.Event()
+                self._waiters.append(ticket)
+        if full:
+            self._reject(429, "queue_full")
+
+        ADMISSION_QUEUED.inc(agent=self.name)
+        admitted = ticket.wait(None if background else self.queue_timeout)
+        with self._lock:
+            # release() sets tickets under the lock, so this check cannot race it.
+            if not admitted and not ticket.is_set():
+                self._waiters.remove(ticket)
+            else:
+                admitted = True
+        ADMISSION_QUEUED.dec(agent=self.name)
+        if not admitted:
+            self._reject(503, "queue_timeout")
+        ADMISSION_QUEUE_TIME.observe(time.perf_counter() - start, agent=self.name)
+
+    def release(self, held_for=None):
+        """
+        Frees a slot, handing it to the oldest waiter if there is one.
+        """
+        if self.concurrency <= 0:
+            return
+        with self._lock:
+            if held_for is not None:
+                self._avg_service = held_for if self._avg_service is None else 0.8 * self._avg_service + 0.2 * held_for
+            if self._waiters:
+                # The slot passes straight to the waiter; _active is unchanged.
+                self._waiters.popleft().set()
+                return
+            self._active -= 1
+        ADMISSION_IN_FLIGHT.dec(agent=self.name)
+
+    @contextmanager
+    def slot(self, background=False):
+        """
+        Context manager holding a slot for the duration of its block. See
+        acquire() for `background`.
+        """
+        self.acquire(background)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - start)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(agent):
+    """
+    Returns the limiter for `agent` ("chat", "description", ...), creating it
+    from the environment settings on first use.
+    """
+    limiter = _limiters.get(agent)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(agent)
+            if limiter is None:
+                prefix = f"ADMISSION_{agent.upper()}_"
+                limiter = _limiters[agent] = AdmissionLimiter(
+                    agent,
+                    int(os.getenv(prefix + "CONCURRENCY", str(ADMISSION_CONCURRENCY))),
+                    int(os.getenv(prefix + "QUEUE", str(ADMISSION_QUEUE))),
+                    float(os.getenv(prefix + "QUEUE_TIMEOUT", str(ADMISSION_QUEUE_TIMEOUT))),
+                )
+    return limiter
+
+
+def admission_controlled(agent):
+    """
+    Decorator running a view function inside a slot of `agent`'s limiter.
+    Overloaded propagates to the app's error handler.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_limiter(agent).slot():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
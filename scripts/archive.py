@@ -0,0 +1,213 @@
+# archive.py
+"""
+Cold storage for ended shopping sessions.
+
+Archived sessions leave the hot CSV tables and are appended, together with
+their product pages, locally stored chat messages and extraction watermark,
+to one gzip-compressed JSON-lines file per month (the month the session
+ended):
+
+    DemoDatabase/archive/sessions-2025-02.jsonl.gz
+        {"session": {...session row...}, "product_pages": [{...}, ...],
+         "chat_messages": [{...}, ...], "extraction": {...} or null}
+    DemoDatabase/archive/index.csv
+        session_id,user_id,month,thread_id
+
+Each archiving run appends a new gzip member, so files are never rewritten.
+The index is small and cached in memory, so checking whether a session is
+archived costs a stat() call.
+
+Sessions are moved here by scripts/archiver.py.
+"""
+import csv
+import gzip
+import json
+import os
+import threading
+from functools import lru_cache
+
+ARCHIVE_DIR = os.path.join("DemoDatabase", "archive")
+ARCHIVE_INDEX_CSV = os.path.join(ARCHIVE_DIR, "index.csv")
+INDEX_FIELDNAMES = ["session_id", "user_id", "month", "thread_id"]
+
+_index_lock = threading.Lock()
+_index_cache = (None, {}, {})  # (file stamp, {session_id: index row}, {thread_id: session_id})
+
+
+def month_path(month):
+    return os.path.join(ARCHIVE_DIR, f"sessions-{month}.jsonl.gz")
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+# ------------------------------------------------------------------------------
+# 1. INDEX
+# ------------------------------------------------------------------------------
+def _load_index():
+    """
+    Returns ({session_id: index row}, {thread_id: session_id}), re-reading the
+    index file only when it changed.
+    """
+    global _index_cache
+    stamp = _stamp(ARCHIVE_INDEX_CSV)
+    with _index_lock:
+        if _index_cache[0] == stamp:
+            return _index_cache[1], _index_cache[2]
+        entries, by_thread = {}, {}
+        if stamp is not None:
+            with open(ARCHIVE_INDEX_CSV, mode="r", encoding="utf-8", newline="") as f:
+                for row in csv.DictReader(f):
+                    entries[row["session_id"]] = row
+                    if row.get("thread_id"):
+                        by_thread[row["thread_id"]] = row["session_id"]
+        _index_cache = (stamp, entries, by_thread)
+        return entries, by_thread
+
+
+def _index():
+    return _load_index()[0]
+
+
+def is_archived(session_id):
+    return str(session_id) in _index()
+
+
+def archived_session_for_thread(thread_id):
+    """
+    ID of the archived session whose chat thread is `thread_id`, or None.
+    """
+    return _load_index()[1].get(str(thread_id))
+
+
+def max_session_id():
+    """
+    Largest archived session ID (0 if none), so new sessions never reuse one.
+    """
+    return max((int(sid) for sid in _index()), default=0)
+
+
+def archived_session_ids(user_id):
+    """
+    IDs of the archived sessions of a user.
+    """
+    return [sid for sid, row in _index().items() if row["user_id"] == str(user_id)]
+
+
+# ------------------------------------------------------------------------------
+# 2. READ
+# ------------------------------------------------------------------------------
+@lru_cache(maxsize=8)
+def _read_month(path, stamp):
+    # `stamp` is part of the cache key, so an appended file is read again.
+    records = {}
+    with gzip.open(path, mode="rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                # A session archived twice (after an interrupted run) keeps its last copy.
+                records[record["session"]["session_id"]] = record
+    return records
+
+
+def _record(session_id):
+    row = _index().get(str(session_id))
+    if row is None:
+        return None
+    path = month_path(row["month"])
+    stamp = _stamp(path)
+    if stamp is None:
+        return None
+    return _read_month(path, stamp).get(str(session_id))
+
+
+def get_archived_session(session_id):
+    """
+    Returns the archived session row, or None.
+    """
+    record = _record(session_id)
+    return dict(record["session"]) if record else None
+
+
+def get_archived_product_pages(session_id):
+    """
+    Returns the product pages archived with the session ([] if none).
+    """
+    record = _record(session_id)
+    return [dict(p) for p in record["product_pages"]] if record else []
+
+
+def get_archived_chat_messages(session_id):
+    """
+    Returns the locally stored chat messages archived with the session, oldest
+    first ([] if none).
+    """
+    record = _record(session_id)
+    return [dict(m) for m in record.get("chat_messages", [])] if record else []
+
+
+def get_archived_extraction(session_id):
+    """
+    Returns the extraction watermark row archived with the session, or None.
+    """
+    record = _record(session_id)
+    extraction = record.get("extraction") if record else None
+    return dict(extraction) if extraction else None
+
+
+# ------------------------------------------------------------------------------
+# 3. WRITE
+# ------------------------------------------------------------------------------
+def append_sessions(month, records):
+    """
+    Appends `records` ({"session": ..., "product_pages": [...], ...}) to the month's
+    archive file and registers them in the index. The data is fsynced before
+    the index names it, so an indexed session is always readable.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(month_path(month), "ab") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+            for record in records:
+                gz.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        raw.flush()
+        os.fsync(raw.fileno())
+
+    _upgrade_index()
+    new_index = not os.path.exists(ARCHIVE_INDEX_CSV)
+    with open(ARCHIVE_INDEX_CSV, mode="a", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_FIELDNAMES)
+        if new_index:
+            writer.writeheader()
+        for record in records:
+            session = record["session"]
+            writer.writerow({
+                "session_id": session["session_id"], "user_id": session["user_id"],
+                "month": month, "thread_id": session.get("thread_id") or "",
+            })
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _upgrade_index():
+    # Indexes written before the thread_id column: rewrite them with the
+    # current header so new rows can be appended.
+    if not os.path.exists(ARCHIVE_INDEX_CSV):
+        return
+    with open(ARCHIVE_INDEX_CSV, mode="r", encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames == INDEX_FIELDNAMES:
+            return
+        rows = list(reader)
+    tmp_path = ARCHIVE_INDEX_CSV + ".upgrade"
+    with open(tmp_path, mode="w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_FIELDNAMES, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, ARCHIVE_INDEX_CSV)
@@ -0,0 +1,113 @@
+# archiver.py
+"""
+Moves ended shopping sessions to the archive (see scripts/archive.py).
+
+Every server process runs a daemon thread that archives sessions which ended
+more than ARCHIVE_AFTER_DAYS ago, every ARCHIVE_INTERVAL seconds. A lock file
+makes sure only one process archives at a time.
+
+Usage:
+    python -m scripts.archiver run [--older-than-days N]   # archive now
+    python -m scripts.archiver show SESSION_ID             # print an archived session
+"""
+import argparse
+import json
+import os
+import threading
+
+from scripts import archive, csv_db
+from scripts.logging_utils import get_logger, fields
+from scripts.metrics import Counter, register
+
+try:
+    import fcntl
+except ImportError:  # Windows: single process, the thread lock is enough
+    fcntl = None
+
+# Sessions that ended more than this many days ago are archived.
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+# Seconds between archiving runs; 0 disables the background archiver.
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+LOCK_FILE = os.path.join(archive.ARCHIVE_DIR, ".lock")
+
+log = get_logger("archiver")
+
+ARCHIVED_SESSIONS = register(Counter(
+    "archived_sessions_total", "Shopping sessions moved from the hot tables to the archive.",
+))
+
+_run_lock = threading.Lock()
+_started_pid = None
+_stop = threading.Event()
+
+
+def run_once(older_than_days=None):
+    """
+    Archives the sessions that ended more than `older_than_days` (default
+    ARCHIVE_AFTER_DAYS) ago. Returns the number of sessions archived, or 0
+    if another process is archiving right now.
+    """
+    if older_than_days is None:
+        older_than_days = ARCHIVE_AFTER_DAYS
+    os.makedirs(archive.ARCHIVE_DIR, exist_ok=True)
+    with _run_lock, open(LOCK_FILE, "a") as lock:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+        try:
+            count = csv_db.archive_ended_sessions(older_than_days)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    if count:
+        ARCHIVED_SESSIONS.inc(count)
+        log.info("Archived ended sessions", extra=fields(sessions=count, older_than_days=older_than_days))
+    return count
+
+
+def _loop():
+    while not _stop.wait(ARCHIVE_INTERVAL):
+        try:
+            run_once()
+        except Exception:
+            log.exception("Archiving run failed")
+
+
+def start_archiver():
+    """
+    Starts the background archiver thread of this process (once per process,
+    so it is started again in each forked worker). No-op if ARCHIVE_INTERVAL is 0.
+    """
+    global _started_pid
+    if ARCHIVE_INTERVAL <= 0 or _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+    threading.Thread(target=_loop, name="ppd-archiver", daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive ended shopping sessions.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="archive ended sessions now")
+    run.add_argument("--older-than-days", type=float, default=ARCHIVE_AFTER_DAYS)
+    show = sub.add_parser("show", help="print an archived session and its product pages")
+    show.add_argument("session_id")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        count = run_once(args.older_than_days)
+        print(f"Archived {count} session(s).")
+    else:
+        session = archive.get_archived_session(args.session_id)
+        if session is None:
+            parser.exit(1, f"Session {args.session_id} is not archived.\n")
+        print(json.dumps({
+            "session": session,
+            "product_pages": archive.get_archived_product_pages(args.session_id),
+        }, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,49 @@
 # assistants_helpers.py
-from scripts.csv_db import get_shopping_session, get_product_pages_by_session_id
+import hashlib
+import json
+import time
+from typing import List
 
+from pydantic import BaseModel
 
-def create_chat_thread(client, user_preferences, intent):
+from scripts.csv_db import (
+    get_shopping_session, get_product_pages_by_session_id,
+    get_preferences_by_user_id, update_user_preferences,
+    get_extraction_watermark, set_extraction_watermark,
+    get_comparison, begin_comparison, set_comparison, add_chat_messages
+)
+from scripts.engines import (
+    make_engine, message_dict, messages_after, new_local_thread_id, new_message_id, recent_messages
+)
+from scripts.logging_utils import get_logger, fields
+from scripts.metrics import COMPARISON_CACHE, DESCRIPTION_LOOKUPS, observe_openai, record_token_usage
+from scripts.product_index import page_source_hash, product_index
+from scripts.prompts import (
+    COMPARISON_INSTRUCTIONS, DESCRIPTION_INSTRUCTIONS, EXTRACTION_SYSTEM_PROMPT, PromptBuilder
+)
+from scripts.tracing import span
+
+log = get_logger("assistants")
+
+
+def create_chat_thread(client, user_preferences, intent, local=False):
     """
     Creates a new Thread using the Assistants API and pre-populates it with two assistant messages.
+    With local=True (the "completions" chat engine) the thread only exists in the
+    local chat history store and no OpenAI call is made.
     
     Args:
         user_demographics (dict): e.g., {"Name": "Alice", "Email": "alice@example.com"}
         user_preferences (list): List of dicts, e.g., [{"preference_key": "budget", "preference_value": "$100-$200"}, ...]
         intent (str): What the user is looking to buy.
         assistant_id (str): The ID of your pre-created Assistant.
+        local (bool): Store the thread locally instead of creating it on OpenAI.
     
     Returns:
         thread_id (str): The ID of the newly created thread.
         initial_messages (list): The list of messages that were added.
     """
-    # Step 1: Create a new thread.
-    thread = client.beta.threads.create()
-    thread_id = thread.id
-
-    # Step 2: Prepare the content for the first assistant message.
+    # Prepare the content for the first assistant message.
     preferences_info = "\n".join(
         f"{pref['preference_key']}: {pref['preference_value']}" for pref in user_preferences
     )
@@ -28,26 +51,45 @@ def create_chat_thread(client, user_preferences, intent):
         f"User Preferences:\n{preferences_info}\n\n"
         f"User Intent: {intent}"
     )
-
-    # Add the first assistant message.
-    msg1 = client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="assistant",
-        content=message1_content
-    )
-
-    # Step 3: Add a second assistant message that asks clarifying questions.
+    # A second assistant message that asks clarifying questions.
     clarifying_questions = (
         "To better assist you, could you please answer a few questions:\n"
         "1. What is your price range?\n"
         "2. Are there any specific brands or features you're looking for?\n"
         "3. Any other details that are important to you?"
     )
-    msg2 = client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="assistant",
-        content=clarifying_questions
-    )
+
+    if local:
+        thread_id = new_local_thread_id()
+        now = int(time.time())
+        initial_messages = [
+            {"message_id": new_message_id(), "role": "assistant", "content": content, "created_at": now}
+            for content in (message1_content, clarifying_questions)
+        ]
+        add_chat_messages(thread_id, initial_messages)
+        return thread_id, initial_messages
+
+    # Step 1: Create a new thread.
+    # The thread belongs to the chat assistant, so its calls are reported under ChatAgent.
+    with observe_openai("ChatAgent", "thread_create"):
+        thread = client.beta.threads.create()
+    thread_id = thread.id
+
+    # Add the first assistant message.
+    with observe_openai("ChatAgent", "message_create"):
+        msg1 = client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="assistant",
+            content=message1_content
+        )
+
+    # Step 3: Add the clarifying questions.
+    with observe_openai("ChatAgent", "message_create"):
+        msg2 = client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role="assistant",
+            content=clarifying_questions
+        )
 
     initial_messages = [msg1, msg2]
     return thread_id, initial_messages
@@ -56,16 +98,19 @@ def create_chat_thread(client, user_preferences, intent):
 
 
 class ChatAgent:
-    def __init__(self, client, assistant_id):
+    def __init__(self, client, assistant_id, engine="assistants"):
         """
         Initialize with an OpenAI client and the assistant_id.
         
         Args:
             client: Your OpenAI client instance.
             assistant_id (str): The ID of your chat assistant.
+            engine (str): "assistants", or "completions" to keep the history locally
+                          and answer each turn with one streamed completion.
         """
         self.client = client
         self.assistant_id = assistant_id
+        self.engine = make_engine(engine, client, assistant_id, "ChatAgent")
 
     def add_message(self, thread_id, user_message):
         """
@@ -79,22 +124,29 @@ class ChatAgent:
         Returns:
             list: The updated list of messages from the thread, or a dict with status if not completed.
         """
+        if self.engine.name == "completions":
+            return self.engine.chat_turn(thread_id, user_message)
+
         # Add the user's message to the thread.
-        self.client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_message
-        )
+        with observe_openai("ChatAgent", "message_create"):
+            self.client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=user_message
+            )
         
         # Create a run on the thread to generate a response from the assistant.
-        run = self.client.beta.threads.runs.create_and_poll(
-            thread_id=thread_id,
-            assistant_id=self.assistant_id
-        )
+        with observe_openai("ChatAgent", "run"):
+            run = self.client.beta.threads.runs.create_and_poll(
+                thread_id=thread_id,
+                assistant_id=self.assistant_id
+            )
+        record_token_usage("ChatAgent", getattr(run, "usage", None))
         
         # Check if the run has completed.
         if run.status == "completed":
-            response = self.client.beta.threads.messages.list(thread_id=thread_id)
+            with observe_openai("ChatAgent", "message_list"):
+                response = self.client.beta.threads.messages.list(thread_id=thread_id)
             messages = []
             # Iterate over the message objects from the response.
             for msg in response.data:
@@ -116,7 +168,8 @@ class ChatAgent:
 
 
 class ProductDescriptionAgent:
-    def __init__(self, client, product_description_assistant_id):
+    def __init__(self, client, product_description_assistant_id, engine="assistants",
+                 reuse="session", grounding=False, grounding_min_score=5.0):
         """
         Initialize the ProductDescriptionAgent with an OpenAI client and 
         the product description assistant ID.
@@ -124,9 +177,53 @@ class ProductDescriptionAgent:
         Args:
             client: Your OpenAI client instance.
             product_description_assistant_id (str): The assistant ID for your product description assistant.
+            engine (str): "assistants" or "completions" (see scripts/engines.py).
+            reuse (str): Return an existing description of the exact same product page instead
+                         of generating one: "session" (only from this session), "any" (from
+                         any session) or "off".
+            grounding (bool): Add the closest stored description (BM25 search over all
+                              sessions) to the prompt as reference material.
+            grounding_min_score (float): Minimum BM25 score for a description to be used.
         """
         self.client = client
         self.product_description_assistant_id = product_description_assistant_id
+        self.engine = make_engine(engine, client, product_description_assistant_id, "ProductDescriptionAgent")
+        if reuse not in ("off", "session", "any"):
+            raise ValueError(f"reuse must be 'off', 'session' or 'any', got {reuse!r}")
+        self.reuse = reuse
+        self.grounding = grounding
+        self.grounding_min_score = grounding_min_score
+
+    def find_reusable(self, session_id, product_page):
+        """
+        Looks up a stored description of the same page (see DESCRIPTION_REUSE).
+        Never calls OpenAI, so callers can check it before taking an admission slot.
+
+        Args:
+            session_id (str): The shopping session ID.
+            product_page (str): A string containing the product webpage information.
+
+        Returns:
+            list: A single assistant message with a "reused_from" key holding the source
+                  session ID, or None if no description can be reused.
+        """
+        if self.reuse == "off":
+            return None
+        with span("product_index_lookup"):
+            match = product_index.find_by_source(
+                page_source_hash(product_page), session_id if self.reuse == "session" else None
+            )
+        # Callers may look up before loading the session: never answer (and so
+        # save a page) for a session that does not exist.
+        if not match or not get_shopping_session(session_id):
+            return None
+        DESCRIPTION_LOOKUPS.inc(outcome="reused")
+        log.info("Reusing stored product description", extra=fields(
+            session_id=session_id, source_session_id=match["session_id"]
+        ))
+        reply = message_dict(new_message_id(), "assistant", int(time.time()), match["product_page"])
+        reply["reused_from"] = match["session_id"]
+        return [reply]
 
     def generate_description(self, session_id, product_page):
         """
@@ -138,10 +235,12 @@ class ProductDescriptionAgent:
         
         Returns:
             list: A list of dictionaries representing the messages generated by the product description assistant,
-                  or a dict with the run status if not completed.
+                  or a dict with the run status if not completed. A reused description is returned as a
+                  single assistant message with a "reused_from" key holding the source session ID.
         """
         # Retrieve the shopping session to get the main conversation's thread_id.
-        session = get_shopping_session(session_id)
+        with span("load_session"):
+            session = get_shopping_session(session_id)
         if not session:
             return {"error": "Session not found."}
 
@@ -149,60 +248,54 @@ class ProductDescriptionAgent:
         if not main_thread_id:
             return {"error": "No thread_id found in session."}
 
+        # The same page was described before (possibly while this call waited
+        # for its admission slot): skip the generation entirely.
+        reused = self.find_reusable(session_id, product_page)
+        if reused is not None:
+            return reused
+
+        reference = None
+        if self.grounding:
+            with span("product_index_search"):
+                # Another session's description: this session's own are already in its conversation.
+                hits = product_index.search(product_page, limit=1, exclude_session_id=session_id)
+            if hits and hits[0][0] >= self.grounding_min_score:
+                reference = hits[0][1]["product_page"]
+        DESCRIPTION_LOOKUPS.inc(outcome="grounded" if reference else "generated")
+
         # Retrieve the conversation from the main thread.
-        conversation_response = self.client.beta.threads.messages.list(thread_id=main_thread_id)
-        conversation_text = ""
-        for msg in conversation_response.data[::-1]:
-            for item in msg.content:
-                if item.type == "text":
-                    conversation_text += item.text.value + "\n"
-
-        # Compose the prompt by combining the pre-shopping conversation and the product page.
-        prompt = (
-            f"Pre-shopping conversation with User:\n{conversation_text}\n"
-            f"Product Page:\n{product_page}\n\n"
-            "Create a tailored product description for this user..."
-        )
+        conversation = recent_messages(self.client, main_thread_id, "ProductDescriptionAgent")
+        conversation_text = "".join(m["content"] + "\n" for m in reversed(conversation))
 
-        # Create a new thread for the product description generation.
-        new_thread = self.client.beta.threads.create()
-        new_thread_id = new_thread.id
+        # Compose the prompt: instructions, then the conversation (the same for
+        # every page described in this session), then the product page.
+        with span("build_prompt"):
+            prompt = (
+                PromptBuilder("ProductDescriptionAgent", DESCRIPTION_INSTRUCTIONS)
+                .stable(f"Pre-shopping conversation with User:\n{conversation_text}")
+                .variable(reference and (
+                    "Reference: an earlier description of a similar product. Use it for product facts "
+                    f"only; do not copy its tailoring.\n{reference}"
+                ))
+                .variable(f"Product Page:\n{product_page}")
+                .build()
+            )
 
-        # Add the composed prompt as a message to the new thread.
-        self.client.beta.threads.messages.create(
-            thread_id=new_thread_id,
-            role="user",  # You can adjust the role as needed.
-            content=prompt
-        )
+        # Run the prompt with the product description assistant.
+        return self.engine.run_prompt(prompt.text, instructions="")
 
-        # Run the thread using the product description assistant.
-        run = self.client.beta.threads.runs.create_and_poll(
-            thread_id=new_thread_id,
-            assistant_id=self.product_description_assistant_id,
-            instructions=""
-        )
 
-        if run.status == "completed":
-            response = self.client.beta.threads.messages.list(thread_id=new_thread_id)
-            messages = []
-            for msg in response.data:
-                text_value = ""
-                for item in msg.content:
-                    if item.type == "text":
-                        text_value += item.text.value
-                messages.append({
-                    "id": msg.id,
-                    "role": msg.role,
-                    "created_at": msg.created_at,
-                    "content": text_value,
-                })
-            return messages
-        else:
-            return {"status": run.status}
+def product_pages_hash(product_pages):
+    """
+    Digest of the set of product pages of a session: the sorted SHA-256 of
+    every page, hashed together (order and duplicates do not matter).
+    """
+    page_hashes = sorted({hashlib.sha256(p["product_page"].encode("utf-8")).hexdigest() for p in product_pages})
+    return hashlib.sha256("\n".join(page_hashes).encode("ascii")).hexdigest()
 
 
 class ComparisonAgent:
-    def __init__(self, client, comparison_assistant_id):
+    def __init__(self, client, comparison_assistant_id, engine="assistants"):
         """
         Initialize the ComparisonAgent with an OpenAI client and 
         the comparison assistant ID.
@@ -210,9 +303,36 @@ class ComparisonAgent:
         Args:
             client: Your OpenAI client instance.
             comparison_assistant_id (str): The assistant ID for your comparison assistant.
+            engine (str): "assistants" or "completions" (see scripts/engines.py).
         """
         self.client = client
         self.comparison_assistant_id = comparison_assistant_id
+        self.engine = make_engine(engine, client, comparison_assistant_id, "ComparisonAgent")
+
+    def cached_comparison(self, session_id, product_pages=None):
+        """
+        Returns the stored comparison of the session if its product pages have not
+        changed since it was computed, or None. Never calls OpenAI, so callers can
+        check it before taking an admission slot.
+
+        Args:
+            session_id (str): The shopping session ID.
+            product_pages (list): The session's product pages, if already loaded.
+
+        Returns:
+            The stored list of assistant messages, or None.
+        """
+        if product_pages is None:
+            with span("load_product_pages"):
+                product_pages = get_product_pages_by_session_id(session_id)
+        # New product pages and chat messages invalidate the cached result, so
+        # an entry for the same page set is still current.
+        cached = get_comparison(session_id)
+        if not cached or not cached["result"] or cached["pages_hash"] != product_pages_hash(product_pages):
+            return None
+        COMPARISON_CACHE.inc(result="hit")
+        log.info("Comparison served from cache", extra=fields(session_id=session_id, created_at=cached["created_at"]))
+        return json.loads(cached["result"])
 
     def generate_comparison(self, session_id):
         """
@@ -221,10 +341,13 @@ class ComparisonAgent:
         The method performs the following steps:
         1. Retrieves all product pages saved for the session.
         2. Retrieves the conversation thread for the session.
-        3. Appends to a new prompt the text for each product page in the format "Product X: {text}".
-        4. Appends an instruction message: "Create a comparison table for these products and output the markdown."
-        5. Creates a new thread, adds the composed prompt as a message, runs the thread using the comparison assistant,
+        3. Builds a prompt from the comparison instructions, the conversation and the text of
+           each product page in the format "Product X: {text}", in that order (see scripts/prompts.py).
+        4. Nothing else follows the products, so repeated comparisons share a long prompt prefix.
+        5. Runs the prompt on the agent's engine (a new Assistants thread, or a single chat completion)
            and returns the model's response (formatted as markdown).
+        If the session's product pages and conversation have not changed since the last
+        completed comparison, the stored result is returned without calling the assistant.
         
         Args:
             session_id (str): The shopping session ID.
@@ -233,70 +356,180 @@ class ComparisonAgent:
             A list of dictionaries representing the assistant's response messages, or a dict with run status if not completed.
         """
         # Retrieve the shopping session to get the main conversation's thread_id.
-        session = get_shopping_session(session_id)
+        with span("load_session"):
+            session = get_shopping_session(session_id)
         if not session:
             return {"error": "Session not found."}
         
         main_thread_id = session.get("thread_id")
         if not main_thread_id:
             return {"error": "No thread_id found in session."}
+
+        with span("load_product_pages"):
+            product_pages = get_product_pages_by_session_id(session_id)
+        pages_hash = product_pages_hash(product_pages)
+
+        # Another call may have stored the comparison while this one waited.
+        result = self.cached_comparison(session_id, product_pages)
+        if result is not None:
+            return result
+        COMPARISON_CACHE.inc(result="miss")
+        # The epoch read here guards the result against changes during the run.
+        epoch = begin_comparison(session_id)["epoch"]
+
+        # Retrieve the conversation from the main thread (newest message first).
+        conversation = recent_messages(self.client, main_thread_id, "ComparisonAgent")
+        conversation_text = "".join(m["content"] + "\n" for m in reversed(conversation))
+
+        with span("build_prompt"):
+            products_text = ""
+            for idx, record in enumerate(product_pages, start=1):
+                products_text += f"#Start: Product {idx} Description#\n: {record['product_page']}\n\n"
+                products_text += f"#End: Product {idx} Description#\n\n"
+            # Compose the prompt: instructions, then the conversation, then the
+            # products. Pages are only ever appended, so a later comparison in the
+            # same session shares everything up to the new products.
+            prompt = (
+                PromptBuilder("ComparisonAgent", COMPARISON_INSTRUCTIONS)
+                .stable(
+                    f"#Start: Pre-shopping conversation with User:\n{conversation_text}#\n\n"
+                    "#End: Pre-shopping conversation with User"
+                )
+                .variable(products_text)
+                .build()
+            )
+
+        log.debug("Comparison prompt built", extra=fields(
+            session_id=session_id, product_count=len(product_pages), prompt_chars=len(prompt.text), prompt=prompt.text
+        ))
         
-        # Retrieve the conversation from the main thread.
-        conversation_response = self.client.beta.threads.messages.list(thread_id=main_thread_id)
-        conversation_text = ""
-        for msg in conversation_response.data[::-1]:
-            for item in msg.content:
-                if item.type == "text":
-                    conversation_text += item.text.value + "\n"
-        
-        product_pages = get_product_pages_by_session_id(session_id)
-        products_text = ""
-        for idx, record in enumerate(product_pages, start=1):
-            products_text += f"#Start: Product {idx} Description#\n: {record['product_page']}\n\n"
-            products_text += f"#End: Product {idx} Description#\n\n"
-        # Compose the prompt.
-        prompt = (
-            f"#Start: Pre-shopping conversation with User:\n{conversation_text}#\n\n"
-            "#End: Pre-shopping conversation with User\n\n"
-            f"{products_text}"
-            "Remove duplicates and pick at most 4 products that best match user needs to create a comparison table for them."
-        )
+        # Run the prompt with the comparison assistant, keeping only its replies.
+        messages = self.engine.run_prompt(prompt.text, assistant_only=True)
+        if isinstance(messages, list):
+            stored = set_comparison(session_id, epoch, pages_hash, json.dumps(messages))
+            if not stored:
+                log.info("Session changed during comparison; result not cached", extra=fields(session_id=session_id))
+        return messages
+
+
+# Define our structured response model for extracting user preferences.
+class Preference(BaseModel):
+    key: str
+    value: str
+
+class PreferenceExtraction(BaseModel):
+    preferences: List[Preference]
+
+
+# Keys whose values are lists, unioned across extractions rather than replaced.
+LIST_PREFERENCE_KEYS = frozenset({
+    "interests", "hobbies", "favorite brands", "preferred brands", "brands",
+    "favorite stores", "dislikes", "allergies", "languages", "pets",
+})
+# A stored value that already uses this separator is treated as a list too.
+# A bare comma is not enough: "$1,000-$1,500" is a single value.
+LIST_SEPARATOR = ", "
+
+
+def merge_preference(existing_value, new_value, key=None):
+    """
+    Merges a newly extracted value into an existing one. Extraction only sees
+    the messages added since the last run, so list-like values (a key in
+    LIST_PREFERENCE_KEYS, or a stored value already joined with ", ", e.g.
+    "Interests") are unioned; every other value is replaced.
+    """
+    if not existing_value:
+        return new_value
+    if key is not None and key.strip().lower() in LIST_PREFERENCE_KEYS:
+        split = lambda value: value.split(",")
+    elif LIST_SEPARATOR in existing_value:
+        split = lambda value: value.split(LIST_SEPARATOR)
+    else:
+        return new_value
+    items = [v.strip() for v in split(existing_value) if v.strip()]
+    seen = {v.lower() for v in items}
+    for v in split(new_value):
+        v = v.strip()
+        if v and v.lower() not in seen:
+            items.append(v)
+            seen.add(v.lower())
+    return LIST_SEPARATOR.join(items)
 
-        print(prompt)
+
+class PreferenceExtractionAgent:
+    def __init__(self, client, model="gpt-4o"):
+        """
+        Initialize the PreferenceExtractionAgent with an OpenAI client.
         
-        # Create a new thread for the comparison task.
-        new_thread = self.client.beta.threads.create()
-        new_thread_id = new_thread.id
+        Args:
+            client: Your OpenAI client instance.
+            model (str): The chat model used for structured extraction.
+        """
+        self.client = client
+        self.model = model
+
+    def extract_preferences(self, session):
+        """
+        Extracts user preferences from the messages added to the session's thread
+        since the last extraction and merges them into the user's preferences.
         
-        # Add the composed prompt as a message to the new thread.
-        self.client.beta.threads.messages.create(
-            thread_id=new_thread_id,
-            role="user",
-            content=prompt
-        )
+        Args:
+            session (dict): The shopping session row.
         
-        # Run the thread using the comparison assistant.
-        run = self.client.beta.threads.runs.create_and_poll(
-            thread_id=new_thread_id,
-            assistant_id=self.comparison_assistant_id
+        Returns:
+            list: The newly extracted preferences as [{"key": ..., "value": ...}, ...].
+                  Empty if there were no new messages.
+        """
+        session_id = session["session_id"]
+        thread_id = session.get("thread_id")
+        watermark = get_extraction_watermark(session_id)
+
+        new_messages = messages_after(self.client, thread_id, watermark, "PreferenceExtractionAgent")
+        if not new_messages:
+            log.info("No new messages to extract", extra=fields(session_id=session_id))
+            return []
+
+        conversation_text = "".join(m["content"] + "\n" for m in new_messages)
+
+        # The system prompt is the same for every extraction; only the new messages vary.
+        messages = (
+            PromptBuilder("PreferenceExtractionAgent", EXTRACTION_SYSTEM_PROMPT)
+            .variable(conversation_text)
+            .build()
+            .as_chat_messages()
         )
-        
-        if run.status == "completed":
-            response = self.client.beta.threads.messages.list(thread_id=new_thread_id)
-            messages = []
-            # Filter to only the assistant's responses.
-            for msg in response.data:
-                if msg.role == "assistant":
-                    text_value = ""
-                    for item in msg.content:
-                        if item.type == "text":
-                            text_value += item.text.value
-                    messages.append({
-                        "id": msg.id,
-                        "role": msg.role,
-                        "created_at": msg.created_at,
-                        "content": text_value,
-                    })
-            return messages
-        else:
-            return {"status": run.status}
\ No newline at end of file
+
+        # Use the structured data extraction feature with the Pydantic model.
+        with observe_openai("PreferenceExtractionAgent", "chat_completion"):
+            extraction = self.client.beta.chat.completions.parse(
+                model=self.model,
+                messages=messages,
+                response_format=PreferenceExtraction
+            )
+        record_token_usage("PreferenceExtractionAgent", getattr(extraction, "usage", None))
+        extracted_prefs = extraction.choices[0].message.parsed
+        pref_list = [{"key": pref.key, "value": pref.value} for pref in extracted_prefs.preferences]
+
+        # Merge locally with what we already know about the user: match keys
+        # case-insensitively so the stored key spelling is kept.
+        user_id = session.get("user_id")
+        existing = {p["preference_key"].lower(): p for p in get_preferences_by_user_id(user_id)}
+        merged = []
+        for pref in pref_list:
+            current = existing.get(pref["key"].lower())
+            if current:
+                merged.append({
+                    "key": current["preference_key"],
+                    "value": merge_preference(current["preference_value"], pref["value"], current["preference_key"]),
+                })
+            else:
+                merged.append(pref)
+        if merged:
+            update_user_preferences(user_id, merged)
+
+        # Only advance the watermark once the preferences are stored.
+        set_extraction_watermark(session_id, new_messages[-1]["id"])
+        log.info("Preferences extracted", extra=fields(
+            session_id=session_id, new_messages=len(new_messages), extracted=len(pref_list)
+        ))
+        return pref_list
@@ -0,0 +1,165 @@
+# auth.py
+"""
+Stateless signed access tokens.
+
+A token is "<payload>.<signature>": the payload is the base64url-encoded JSON
+{"uid": user_id, "exp": unix_expiry} and the signature is the base64url
+HMAC-SHA256 of the payload under a local secret. Verifying a token needs only
+the secret, never the users table.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import tempfile
+import time
+
+# Tokens stop verifying after this many seconds.
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", "43200"))
+# Signing secret. When unset, one is generated once and kept in AUTH_SECRET_FILE
+# so that every worker process and restart signs with the same key.
+AUTH_SECRET = os.getenv("AUTH_SECRET", "")
+AUTH_SECRET_FILE = os.getenv("AUTH_SECRET_FILE", "DemoDatabase/auth_secret")
+
+
+class InvalidToken(ValueError):
+    """Raised for malformed, forged or expired tokens."""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+# How long to wait for a secret file another process is creating, and the
+# age after which an empty secret file is considered left over by a crash.
+SECRET_WAIT_SECONDS = 2.0
+
+
+def _read_secret_file():
+    try:
+        with open(AUTH_SECRET_FILE, "r", encoding="utf-8") as f:
+            return f.read().strip(), os.fstat(f.fileno())
+    except FileNotFoundError:
+        return None, None
+
+
+def _create_secret_file():
+    """
+    Publishes a new secret unless the file exists: the secret is written to a
+    temp file and linked into place, so the file never exists half-written.
+    Returns True if this call created it.
+    """
+    directory = os.path.dirname(AUTH_SECRET_FILE) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".auth_secret.", dir=directory)  # mode 0600
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(secrets.token_hex(32))
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            # link() fails if the file exists: if several processes start at
+            # once, exactly one secret is published.
+            os.link(tmp_path, AUTH_SECRET_FILE)
+            return True
+        except FileExistsError:
+            return False
+    finally:
+        os.remove(tmp_path)
+
+
+def _load_secret():
+    if AUTH_SECRET:
+        return AUTH_SECRET.encode("utf-8")
+    deadline = time.monotonic() + SECRET_WAIT_SECONDS
+    while True:
+        secret, st = _read_secret_file()
+        if secret:
+            return secret.encode("utf-8")
+        if st is None:
+            _create_secret_file()
+            continue
+        # An empty file: written by an older version that crashed between
+        # creating and writing it. Replace it once it is clearly abandoned.
+        if time.time() - st.st_mtime > SECRET_WAIT_SECONDS:
+            try:
+                if os.stat(AUTH_SECRET_FILE).st_ino == st.st_ino:
+                    os.remove(AUTH_SECRET_FILE)
+            except FileNotFoundError:
+                pass
+            continue
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{AUTH_SECRET_FILE} is empty; delete it or set AUTH_SECRET")
+        time.sleep(0.05)
+
+
+_secret = None
+
+
+def _signing_key():
+    global _secret
+    if _secret is None:
+        _secret = _load_secret()
+    return _secret
+
+
+def _sign(payload):
+    return hmac.new(_signing_key(), payload.encode("utf-8"), hashlib.sha256).digest()
+
+
+def issue_token(user_id, ttl=None):
+    """
+    Creates a signed token for `user_id`.
+
+    Returns:
+        tuple: (token, expires_at) with expires_at as a unix timestamp.
+    """
+    expires_at = int(time.time()) + (AUTH_TOKEN_TTL if ttl is None else ttl)
+    payload = _b64encode(json.dumps({"uid": str(user_id), "exp": expires_at}, separators=(",", ":")).encode("utf-8"))
+    return f"{payload}.{_b64encode(_sign(payload))}", expires_at
+
+
+def verify_token(token):
+    """
+    Checks the signature (in constant time) and the expiry of `token`.
+
+    Returns:
+        str: The user_id the token was issued for.
+
+    Raises:
+        InvalidToken: If the token is malformed, forged or expired.
+    """
+    payload, sep, signature = token.partition(".")
+    if not sep or not payload:
+        raise InvalidToken("malformed token")
+    try:
+        supplied = _b64decode(signature)
+    except ValueError:
+        raise InvalidToken("malformed token")
+    if not hmac.compare_digest(supplied, _sign(payload)):
+        raise InvalidToken("bad signature")
+    try:
+        claims = json.loads(_b64decode(payload))
+        user_id, expires_at = str(claims["uid"]), int(claims["exp"])
+    except (ValueError, KeyError, TypeError):
+        raise InvalidToken("malformed token")
+    if expires_at < time.time():
+        raise InvalidToken("token expired")
+    return user_id
+
+
+def bearer_token(authorization):
+    """
+    Extracts the token from an "Authorization: Bearer <token>" header value, or
+    returns None when there is none.
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
@@ -0,0 +1,47 @@
+# background.py
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from scripts.logging_utils import get_logger, fields
+
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))
+
+log = get_logger("background")
+
+
+class BackgroundTasks:
+    """
+    Small thread pool for work that should not hold up a response.
+    Tasks submitted with the same key never run concurrently: a second task for
+    a key waits for the first, so e.g. two /end calls for one session are
+    processed one after the other.
+    """
+    def __init__(self, max_workers=BACKGROUND_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ppd-bg")
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, key):
+        with self._locks_guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Schedules func(*args, **kwargs) and returns its Future. Exceptions are
+        logged rather than lost.
+        """
+        def run():
+            with self._lock_for(key):
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    log.exception("Background task failed", extra=fields(key=key))
+                    raise
+        return self._executor.submit(run)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+background_tasks = BackgroundTasks()
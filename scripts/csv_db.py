@@ -1,27 +1,127 @@
 import csv
+import heapq
 import os
-from datetime import datetime
+import stat
+import tempfile
+import threading
+import zlib
+from datetime import datetime, timedelta
+from functools import wraps
+from itertools import islice
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from scripts import archive, snapshot
+from scripts.metrics import observe_storage
+from scripts.write_behind import WriteBehindStore
 
 USERS_CSV = os.path.join("DemoDatabase", "users.csv")
 PREFERENCES_CSV = os.path.join("DemoDatabase", "user_preferences.csv")
 SESSIONS_CSV = os.path.join("DemoDatabase", "shopping_sessions.csv")
 PRODUCT_PAGES_CSV = os.path.join("DemoDatabase", "product_pages.csv")
+EXTRACTIONS_CSV = os.path.join("DemoDatabase", "session_extractions.csv")
+COMPARISONS_CSV = os.path.join("DemoDatabase", "session_comparisons.csv")
+CHAT_MESSAGES_CSV = os.path.join("DemoDatabase", "chat_messages.csv")
+
+# Write-behind: saves update an in-memory copy of the table and a background
+# thread writes them to disk in batches at most CSV_FLUSH_INTERVAL seconds later.
+CSV_WRITE_BEHIND = os.getenv("CSV_WRITE_BEHIND", "0") == "1"
+CSV_FLUSH_INTERVAL = float(os.getenv("CSV_FLUSH_INTERVAL", "0.5"))
+# "always": fsync every table write; "shutdown": only on the final write-behind
+# flush; "never": leave it to the OS.
+CSV_FSYNC = os.getenv("CSV_FSYNC", "never")
+# Keep a binary snapshot (<table>.csv.snap, see scripts/snapshot.py) next to
+# every CSV and load from it while it matches the CSV.
+CSV_SNAPSHOTS = os.getenv("CSV_SNAPSHOTS", "0") == "1"
+
+# Every mutator below is a load/modify/save of a whole table. Background work
+# (e.g. preference extraction) writes concurrently with request threads, and
+# other processes (gunicorn workers, the archiver and reshard CLIs) write the
+# same files, so mutations are serialized to avoid lost updates: by an RLock
+# within the process and by an flock on WRITE_LOCK_FILE across processes.
+WRITE_LOCK_FILE = os.path.join("DemoDatabase", ".write.lock")
+_write_lock = threading.RLock()
+_lock_depth = 0
+_lock_file = (None, None)  # (pid, open file), reopened in a forked child
+
+def _acquire_file_lock():
+    global _lock_file
+    if fcntl is None:  # Windows: no flock, the in-process lock still applies
+        return
+    pid, f = _lock_file
+    if pid != os.getpid():
+        os.makedirs(os.path.dirname(WRITE_LOCK_FILE), exist_ok=True)
+        f = open(WRITE_LOCK_FILE, "a")
+        _lock_file = (os.getpid(), f)
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+def _release_file_lock():
+    if fcntl is None:
+        return
+    fcntl.flock(_lock_file[1].fileno(), fcntl.LOCK_UN)
+
+def _locked(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        global _lock_depth
+        with _write_lock:
+            if _lock_depth == 0:
+                _acquire_file_lock()
+            _lock_depth += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _lock_depth -= 1
+                if _lock_depth == 0:
+                    _release_file_lock()
+    return wrapper
 
 # ------------------------------------------------------------------------------
 # 1. CSV READ/WRITE UTILITY FUNCTIONS
 # ------------------------------------------------------------------------------
+def _table_name(filepath):
+    # "DemoDatabase/users.csv" -> "users", used as the metrics/trace label.
+    # Shard files are labelled with their table: ".../shards/users/shard_003.csv" -> "users".
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    if name.startswith("shard_"):
+        return os.path.basename(os.path.dirname(filepath))
+    return name
+
 def load_csv(filepath, fieldnames=None):
     """
     Reads a CSV file and returns a list of dicts.
     If fieldnames is None, use the first row as headers.
     """
+    with observe_storage(_table_name(filepath), "read"):
+        if _write_behind is not None:
+            return _write_behind.load(filepath, fieldnames)
+        return _read_csv(filepath, fieldnames)
+
+def _read_csv(filepath, fieldnames=None):
     if not os.path.exists(filepath):
         # Return an empty list if file doesn't exist
         return []
+
+    use_snapshot = CSV_SNAPSHOTS and fieldnames is None
+    if use_snapshot:
+        rows = snapshot.load_if_fresh(filepath)
+        if rows is not None:
+            return rows
     
     with open(filepath, mode="r", encoding="utf-8") as f:
+        # Stamp of the file version being read (the path may be replaced meanwhile).
+        source = snapshot.source_stamp(os.fstat(f.fileno()))
         reader = csv.DictReader(f, fieldnames=fieldnames)
         rows = list(reader)
+        if use_snapshot:
+            # Missing or stale snapshot: refresh it so the next load is fast.
+            try:
+                snapshot.write_snapshot_for(filepath, rows, reader.fieldnames or [], source)
+            except OSError:
+                pass
         # If we didn't provide fieldnames explicitly, DictReader automatically
         # takes them from the first row.
         # So if we provided them, we might want to skip the first row if it's a header row.
@@ -34,18 +134,276 @@ def load_csv(filepath, fieldnames=None):
             pass
     return rows
 
+def iter_csv(filepath):
+    """
+    Yields the rows of a CSV file one dict at a time, without materializing
+    the whole table. The file stays open until the generator is exhausted or closed.
+    """
+    if _write_behind is not None:
+        yield from _write_behind.iter_rows(filepath)
+        return
+    if not os.path.exists(filepath):
+        return
+    with open(filepath, mode="r", encoding="utf-8") as f:
+        yield from csv.DictReader(f)
+
 def save_csv(filepath, rows, fieldnames):
     """
     Writes a list of dicts to a CSV file using the specified fieldnames.
-    Overwrites the entire file.
-    """
+    Overwrites the entire file. In write-behind mode the table is updated in
+    memory and written by the flusher thread shortly after.
+    """
+    if _write_behind is not None:
+        _write_behind.save(filepath, rows, fieldnames)
+        return
+    with observe_storage(_table_name(filepath), "write"):
+        _write_csv(filepath, rows, fieldnames, fsync=CSV_FSYNC == "always")
+
+def _mkstemp_for(filepath):
+    """
+    Creates a unique temp file next to `filepath` (same directory, so
+    os.replace is atomic) with the permissions of the file it will replace.
+    Returns (fd, path).
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(filepath) + ".", suffix=".tmp", dir=os.path.dirname(filepath) or "."
+    )
+    try:
+        mode = stat.S_IMODE(os.stat(filepath).st_mode)
+    except OSError:
+        mode = 0o644
+    os.chmod(tmp_path, mode)
+    return fd, tmp_path
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def _write_csv(filepath, rows, fieldnames, fsync=False):
     # Ensure directory exists
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    
-    with open(filepath, mode="w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
+
+    # Write to a temporary file and swap it in, so readers never see a half-written table.
+    # The temp file is unique, so concurrent writers (another process, the
+    # reshard/snapshot CLIs) never write into or rename each other's file.
+    fd, tmp_path = _mkstemp_for(filepath)
+    try:
+        with open(fd, mode="w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+            # os.replace keeps size and mtime, so this is the stamp of the new table.
+            source = snapshot.source_stamp(os.fstat(f.fileno()))
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+    if CSV_SNAPSHOTS:
+        snapshot.write_snapshot_for(filepath, rows, fieldnames, source, restval="")
+
+def _flush_csv(filepath, rows, fieldnames, fsync):
+    with observe_storage(_table_name(filepath), "flush"):
+        _write_csv(filepath, rows, fieldnames, fsync=fsync)
+
+def flush_pending_writes():
+    """
+    Writes any tables still held by the write-behind store. No-op otherwise.
+    """
+    if _write_behind is not None:
+        _write_behind.flush()
+
+# Write-behind mode is opt-in: it is only coherent within a single process.
+_write_behind = None
+if CSV_WRITE_BEHIND:
+    _write_behind = WriteBehindStore(
+        reader=_read_csv, writer=_flush_csv, table_name=_table_name,
+        flush_interval=CSV_FLUSH_INTERVAL, fsync=CSV_FSYNC,
+    )
+
+# ------------------------------------------------------------------------------
+# 1b. SHARD ROUTING
+# ------------------------------------------------------------------------------
+# The preferences, sessions, product pages, chat history and comparison tables can be
+# hash-partitioned into N shard files under DemoDatabase/shards/<table>/shard_NNN.csv,
+# so a request only reads and rewrites the shard holding its user or session.
+# The layout is created with `python -m scripts.reshard --shards N`; the shard
+# count is read from shards/layout.csv, and no layout file means the classic
+# single-file tables.
+SHARDS_DIR = os.path.join("DemoDatabase", "shards")
+SHARD_LAYOUT_CSV = os.path.join(SHARDS_DIR, "layout.csv")
+# session_id -> user_id, so sessions (sharded by user) can be found by ID. The
+# index is itself sharded, by session_id, so a lookup reads one small shard
+# (shards/session_index/shard_NNN.csv) instead of a file listing every session.
+SESSION_INDEX_CSV = os.path.join(SHARDS_DIR, "session_index.csv")
+SESSION_INDEX_FIELDNAMES = ["session_id", "user_id"]
+# Next free ID per table, since no single shard knows the global maximum.
+SEQUENCES_CSV = os.path.join(SHARDS_DIR, "sequences.csv")
+
+# Column each sharded table is partitioned by.
+SHARD_KEYS = {
+    PREFERENCES_CSV: "user_id",
+    SESSIONS_CSV: "user_id",
+    PRODUCT_PAGES_CSV: "session_id",
+    CHAT_MESSAGES_CSV: "thread_id",
+    SESSION_INDEX_CSV: "session_id",
+    COMPARISONS_CSV: "session_id",
+}
+
+def _read_shard_count():
+    rows = _read_csv(SHARD_LAYOUT_CSV)
+    return int(rows[0]["shards"]) if rows else 0
+
+_shard_count = _read_shard_count()
+
+def is_sharded():
+    return _shard_count > 0
+
+def shard_index(key, shard_count=None):
+    """
+    Stable shard number for a routing key (crc32, so it is the same in every process).
+    """
+    shard_count = shard_count or _shard_count
+    return zlib.crc32(str(key).encode("utf-8")) % shard_count
+
+def shard_path(table_csv, key=None, shard_count=None, index=None, shards_dir=None):
+    """
+    Path of the shard file of `table_csv` that holds `key` (or shard `index`).
+    """
+    if index is None:
+        index = shard_index(key, shard_count)
+    table = os.path.splitext(os.path.basename(table_csv))[0]
+    return os.path.join(shards_dir or SHARDS_DIR, table, f"shard_{index:03d}.csv")
+
+def _all_shard_paths(table_csv):
+    return [shard_path(table_csv, index=i) for i in range(_shard_count)]
+
+def _load_table(table_csv, key=None):
+    """
+    Loads a (possibly sharded) table. With a key only its shard is read,
+    otherwise all shards are concatenated.
+    """
+    if not is_sharded():
+        return load_csv(table_csv)
+    if key is not None:
+        return load_csv(shard_path(table_csv, key))
+    rows = []
+    for path in _all_shard_paths(table_csv):
+        rows.extend(load_csv(path))
+    return rows
+
+def _iter_table(table_csv, key=None):
+    if not is_sharded():
+        yield from iter_csv(table_csv)
+    elif key is not None:
+        yield from iter_csv(shard_path(table_csv, key))
+    else:
+        for path in _all_shard_paths(table_csv):
+            yield from iter_csv(path)
+
+def _save_table(table_csv, rows, fieldnames, key=None):
+    """
+    Saves a (possibly sharded) table. With a key the rows are written to that
+    key's shard; without one they are split across all shards by SHARD_KEYS.
+    """
+    if not is_sharded():
+        save_csv(table_csv, rows, fieldnames)
+    elif key is not None:
+        save_csv(shard_path(table_csv, key), rows, fieldnames)
+    else:
+        by_shard = {i: [] for i in range(_shard_count)}
+        for row in rows:
+            by_shard[shard_index(row[SHARD_KEYS[table_csv]])].append(row)
+        for i, shard_rows in by_shard.items():
+            save_csv(shard_path(table_csv, index=i), shard_rows, fieldnames)
+
+def _max_id(rows, id_field):
+    max_id = 0
+    for r in rows:
+        rid = int(r[id_field])
+        if rid > max_id:
+            max_id = rid
+    return max_id
+
+# Sharded tables take IDs from SEQUENCES_CSV in blocks of this size, so the
+# sequences file is rewritten once per block rather than on every insert.
+ID_BLOCK_SIZE = 64
+_id_blocks = {}  # table name -> [next id, last id of the reserved block]
+
+@_locked
+def _next_id(table_csv, id_field, loaded_rows, used_id=0):
+    """
+    Returns the next free ID (as a string) for a table. Unsharded tables use
+    max + 1 over `loaded_rows` (the whole table); sharded tables use a sequence
+    in SEQUENCES_CSV, because `loaded_rows` is only one shard. `used_id` is
+    the largest ID taken outside the table (e.g. by archived rows).
+    """
+    if not is_sharded():
+        return str(max(_max_id(loaded_rows, id_field), used_id) + 1)
+
+    name = _table_name(table_csv)
+    block = _id_blocks.get(name)
+    if block is None or block[0] > block[1]:
+        last = _reserve_ids(table_csv, id_field, used_id)
+        block = _id_blocks[name] = [last - ID_BLOCK_SIZE + 1, last]
+    block[0] += 1
+    return str(block[0] - 1)
+
+def _reserve_ids(table_csv, id_field, used_id):
+    # Advances the table's sequence by a block and returns the block's last ID.
+    name = _table_name(table_csv)
+    sequences = load_csv(SEQUENCES_CSV)
+    for row in sequences:
+        if row["name"] == name:
+            break
+    else:
+        # No sequence yet: start after the largest ID in any shard.
+        row = {"name": name, "value": str(max(_max_id(_load_table(table_csv), id_field), used_id))}
+        sequences.append(row)
+    # IDs used outside the table (archived sessions) are never handed out again,
+    # even if the sequence was seeded without them.
+    row["value"] = str(max(int(row["value"]), used_id) + ID_BLOCK_SIZE)
+    save_csv(SEQUENCES_CSV, sequences, ["name", "value"])
+    return int(row["value"])
+
+def _forget_id_blocks():
+    # A forked worker must not hand out IDs from its parent's block.
+    _id_blocks.clear()
+
+os.register_at_fork(after_in_child=_forget_id_blocks)
+
+def _session_owner(session_id):
+    session_id = str(session_id)
+    for row in iter_csv(shard_path(SESSION_INDEX_CSV, session_id)):
+        if row["session_id"] == session_id:
+            return row["user_id"]
+    # Layouts created before the index was sharded keep it in one file.
+    for row in iter_csv(SESSION_INDEX_CSV):
+        if row["session_id"] == session_id:
+            return row["user_id"]
+    return None
+
+@_locked
+def _add_session_owner(session_id, user_id):
+    path = shard_path(SESSION_INDEX_CSV, session_id)
+    rows = load_csv(path)
+    rows.append({"session_id": str(session_id), "user_id": str(user_id)})
+    save_csv(path, rows, SESSION_INDEX_FIELDNAMES)
+
+@_locked
+def _remove_session_owners(session_ids):
+    by_path = {}
+    for session_id in session_ids:
+        by_path.setdefault(shard_path(SESSION_INDEX_CSV, session_id), set()).add(str(session_id))
+    if os.path.exists(SESSION_INDEX_CSV):
+        by_path[SESSION_INDEX_CSV] = {str(sid) for sid in session_ids}
+    for path, ids in by_path.items():
+        rows = load_csv(path)
+        save_csv(path, [r for r in rows if r["session_id"] not in ids], SESSION_INDEX_FIELDNAMES)
 
 # ------------------------------------------------------------------------------
 # 2. USERS
@@ -67,6 +425,7 @@ def save_users(users_list):
     fieldnames = ["user_id", "name", "email", "password", "created_at"]
     save_csv(USERS_CSV, users_list, fieldnames)
 
+@_locked
 def create_user(name, email, password):
     """
     Creates a new user, appending to users.csv.
@@ -124,33 +483,36 @@ def get_user_by_email(email):
 # ------------------------------------------------------------------------------
 # 3. USER PREFERENCES
 # ------------------------------------------------------------------------------
-def load_preferences():
+def load_preferences(user_id=None):
     """
     Load preferences from CSV.
     Returns a list of dicts with keys:
       ['preference_id', 'user_id', 'preference_key', 'preference_value']
+    When the data directory is sharded and `user_id` is given, only the shard
+    holding that user is read (it may contain other users too).
     """
-    return load_csv(PREFERENCES_CSV)  # Let DictReader infer headers
+    return _load_table(PREFERENCES_CSV, key=user_id)  # Let DictReader infer headers
 
-def save_preferences(prefs_list):
+def save_preferences(prefs_list, user_id=None):
     """
-    Save preferences to CSV.
+    Save preferences to CSV. Pass the `user_id` used to load a single shard.
     """
     fieldnames = ["preference_id", "user_id", "preference_key", "preference_value"]
-    save_csv(PREFERENCES_CSV, prefs_list, fieldnames)
+    _save_table(PREFERENCES_CSV, prefs_list, fieldnames, key=user_id)
 
 def get_preferences_by_user_id(user_id):
     """
     Returns a list of preference dicts for the given user_id.
     """
     user_id_str = str(user_id)
-    prefs = load_preferences()
+    prefs = load_preferences(user_id)
     user_prefs = []
     for p in prefs:
         if p["user_id"] == user_id_str:
             user_prefs.append(p)
     return user_prefs
 
+@_locked
 def update_user_preferences(user_id, pref_list):
     """
     Create or update multiple preferences for a user.
@@ -159,20 +521,13 @@ def update_user_preferences(user_id, pref_list):
     Returns the updated list of preferences for that user.
     """
     user_id_str = str(user_id)
-    all_prefs = load_preferences()
+    all_prefs = load_preferences(user_id)
 
     # We'll create a map of preference_key -> preference_id for quick lookup
     # among existing preferences for this user.
     existing_prefs = [p for p in all_prefs if p["user_id"] == user_id_str]
     pref_key_to_id = {p["preference_key"]: p["preference_id"] for p in existing_prefs}
 
-    # We need to find the max preference_id across all preferences
-    max_id = 0
-    for p in all_prefs:
-        pid = int(p["preference_id"])
-        if pid > max_id:
-            max_id = pid
-
     for new_pref in pref_list:
         key = new_pref["key"]
         value = new_pref["value"]
@@ -186,37 +541,40 @@ def update_user_preferences(user_id, pref_list):
                     break
         else:
             # Create new preference
-            max_id += 1
+            new_id = _next_id(PREFERENCES_CSV, "preference_id", all_prefs)
             new_p = {
-                "preference_id": str(max_id),
+                "preference_id": new_id,
                 "user_id": user_id_str,
                 "preference_key": key,
                 "preference_value": value
             }
             all_prefs.append(new_p)
-            pref_key_to_id[key] = str(max_id)  # track newly added
+            pref_key_to_id[key] = new_id  # track newly added
 
-    save_preferences(all_prefs)
-    return get_preferences_by_user_id(user_id)
+    save_preferences(all_prefs, user_id)
+    return [p for p in all_prefs if p["user_id"] == user_id_str]
 
 # ------------------------------------------------------------------------------
 # 4. SHOPPING SESSIONS
 # ------------------------------------------------------------------------------
-def load_shopping_sessions():
+def load_shopping_sessions(user_id=None):
     """
     Load shopping sessions from CSV.
     Returns a list of dicts with keys:
-      ['session_id', 'user_id', 'thread_id', 'intent', 'created_at', 'updated_at']
+      ['session_id', 'user_id', 'thread_id', 'intent', 'created_at', 'updated_at', 'ended_at']
+    `ended_at` is empty while the session is open. Archived sessions are not included.
+    When sharded and `user_id` is given, only that user's shard is read.
     """
-    return load_csv(SESSIONS_CSV)
+    return _load_table(SESSIONS_CSV, key=user_id)
 
-def save_shopping_sessions(sessions_list):
+def save_shopping_sessions(sessions_list, user_id=None):
     """
-    Save shopping sessions to CSV.
+    Save shopping sessions to CSV. Pass the `user_id` used to load a single shard.
     """
-    fieldnames = ["session_id", "user_id", "thread_id", "intent", "created_at", "updated_at"]
-    save_csv(SESSIONS_CSV, sessions_list, fieldnames)
+    fieldnames = ["session_id", "user_id", "thread_id", "intent", "created_at", "updated_at", "ended_at"]
+    _save_table(SESSIONS_CSV, sessions_list, fieldnames, key=user_id)
 
+@_locked
 def create_shopping_session(user_id, intent, thread_id=None):
     """
     Creates a new shopping session.
@@ -224,97 +582,421 @@ def create_shopping_session(user_id, intent, thread_id=None):
     - intent (str)
     - thread_id (str) from OpenAI conversation, if already created
     """
-    sessions = load_shopping_sessions()
+    sessions = load_shopping_sessions(user_id)
 
     # Generate new session_id
-    max_id = 0
-    for s in sessions:
-        sid = int(s["session_id"])
-        if sid > max_id:
-            max_id = sid
-    new_id = max_id + 1
+    new_id = _next_id(SESSIONS_CSV, "session_id", sessions, used_id=archive.max_session_id())
 
     now_str = datetime.now().isoformat()
 
     new_session = {
-        "session_id": str(new_id),
+        "session_id": new_id,
         "user_id": str(user_id),
         "thread_id": thread_id if thread_id else "",
         "intent": intent,
         "created_at": now_str,
-        "updated_at": now_str
+        "updated_at": now_str,
+        "ended_at": ""
     }
 
     sessions.append(new_session)
-    save_shopping_sessions(sessions)
+    save_shopping_sessions(sessions, user_id)
+    if is_sharded():
+        _add_session_owner(new_id, user_id)
     return new_session
 
-def get_shopping_session(session_id):
+def _find_session(session_id):
     """
-    Retrieve a shopping session by ID.
+    Returns (sessions, session, owner_user_id): the loaded table/shard, the
+    matching row (or None) and the user_id used to route to the shard.
     """
     session_id_str = str(session_id)
-    sessions = load_shopping_sessions()
+    owner = None
+    if is_sharded():
+        owner = _session_owner(session_id_str)
+        if owner is None:
+            return [], None, None
+    sessions = load_shopping_sessions(owner)
     for s in sessions:
         if s["session_id"] == session_id_str:
-            return s
-    return None
+            return sessions, s, owner
+    return sessions, None, owner
+
+def get_shopping_session(session_id):
+    """
+    Retrieve a shopping session by ID, from the archive if it is no longer in
+    the hot table.
+    """
+    session = _find_session(session_id)[1]
+    if session is None and archive.is_archived(session_id):
+        session = archive.get_archived_session(session_id)
+    return session
 
+@_locked
 def update_shopping_session(session_id, intent=None, thread_id=None):
     """
     Update certain fields (intent, thread_id) of a shopping session.
     """
-    sessions = load_shopping_sessions()
-    now_str = datetime.now().isoformat()
-
-    updated_session = None
-    for s in sessions:
-        if s["session_id"] == str(session_id):
-            if intent is not None:
-                s["intent"] = intent
-            if thread_id is not None:
-                s["thread_id"] = thread_id
-            s["updated_at"] = now_str
-            updated_session = s
-            break
-
+    sessions, updated_session, owner = _find_session(session_id)
     if updated_session:
-        save_shopping_sessions(sessions)
+        if intent is not None:
+            updated_session["intent"] = intent
+        if thread_id is not None:
+            updated_session["thread_id"] = thread_id
+        updated_session["updated_at"] = datetime.now().isoformat()
+        save_shopping_sessions(sessions, owner)
     return updated_session
 
-def get_shopping_sessions_by_user_id(user_id):
+@_locked
+def end_shopping_session(session_id):
     """
-    Retrieve all shopping sessions associated with the given user_id.
-    Returns a list of session dictionaries.
+    Marks a session as ended (once; later calls keep the first ended_at).
+    Returns the session, or None if it is not in the hot table.
     """
-    user_id_str = str(user_id)
+    sessions, session, owner = _find_session(session_id)
+    if session and not session.get("ended_at"):
+        now_str = datetime.now().isoformat()
+        session["ended_at"] = now_str
+        session["updated_at"] = now_str
+        save_shopping_sessions(sessions, owner)
+    return session
+
+@_locked
+def archive_ended_sessions(older_than_days):
+    """
+    Moves sessions that ended more than `older_than_days` ago, with their
+    product pages, chat messages and extraction watermark, from the hot
+    tables into the monthly archive files (cached comparisons are dropped).
+    Returns the number of sessions archived.
+    """
+    cutoff = (datetime.now() - timedelta(days=older_than_days)).isoformat()
     sessions = load_shopping_sessions()
-    user_sessions = [s for s in sessions if s["user_id"] == user_id_str]
-    return user_sessions
+    to_archive = [s for s in sessions if s.get("ended_at") and s["ended_at"] < cutoff]
+    if not to_archive:
+        return 0
+    archived_ids = {s["session_id"] for s in to_archive}
+
+    pages = load_product_pages()
+    pages_by_session = {}
+    for page in pages:
+        if page["session_id"] in archived_ids:
+            pages_by_session.setdefault(page["session_id"], []).append(page)
+
+    # Locally stored transcripts (completions engine) and extraction
+    # watermarks leave the hot tables with their session.
+    archived_threads = {s["thread_id"]: s["session_id"] for s in to_archive if s.get("thread_id")}
+    chat_messages = load_chat_messages()
+    messages_by_session = {}
+    for message in chat_messages:
+        session_id = archived_threads.get(message["thread_id"])
+        if session_id is not None:
+            messages_by_session.setdefault(session_id, []).append(message)
+    watermarks = load_extraction_watermarks()
+    watermark_by_session = {w["session_id"]: w for w in watermarks if w["session_id"] in archived_ids}
+
+    by_month = {}
+    for s in to_archive:
+        by_month.setdefault(s["ended_at"][:7], []).append({
+            "session": s,
+            "product_pages": pages_by_session.get(s["session_id"], []),
+            "chat_messages": messages_by_session.get(s["session_id"], []),
+            "extraction": watermark_by_session.get(s["session_id"]),
+        })
+    # Write the archive first: if anything below fails, the sessions are
+    # still in the hot tables and reads never miss them.
+    for month, records in sorted(by_month.items()):
+        archive.append_sessions(month, records)
+
+    save_shopping_sessions([s for s in sessions if s["session_id"] not in archived_ids])
+    save_product_pages([p for p in pages if p["session_id"] not in archived_ids])
+    if messages_by_session:
+        save_chat_messages([m for m in chat_messages if m["thread_id"] not in archived_threads])
+    if watermark_by_session:
+        save_extraction_watermarks([w for w in watermarks if w["session_id"] not in archived_ids])
+    # A cached comparison is not archived: it is recomputed if ever needed.
+    comparisons = load_comparisons()
+    save_comparisons([c for c in comparisons if c["session_id"] not in archived_ids])
+    if is_sharded():
+        _remove_session_owners(archived_ids)
+    return len(to_archive)
+
+def iter_shopping_sessions_by_user_id(user_id, after=None, created_from=None, created_to=None, intent=None,
+                                      include_archived=True):
+    """
+    Lazily yields the sessions of `user_id` in session_id order (archived
+    sessions are merged in unless include_archived is False).
+    - after (str/int): cursor; only sessions with a larger session_id are returned.
+    - created_from / created_to (str): inclusive ISO bounds on created_at. A bound
+      is compared at its own precision, so "2025-02-06" matches the whole day.
+    - intent (str): case-insensitive substring the session intent must contain.
+    """
+    user_id_str = str(user_id)
+    after_id = int(after) if after not in (None, "") else None
+    intent_lower = intent.lower() if intent else None
+
+    # Sort the user's rows: sharded tables hand out IDs in per-process blocks,
+    # so rows are not stored in session_id order (one user's rows are few).
+    rows = sorted(
+        (s for s in _iter_table(SESSIONS_CSV, key=user_id) if s["user_id"] == user_id_str),
+        key=lambda s: int(s["session_id"]),
+    )
+    archived_ids = archive.archived_session_ids(user_id) if include_archived else []
+    if archived_ids:
+        archived = [archive.get_archived_session(sid) for sid in archived_ids]
+        archived = sorted((s for s in archived if s is not None), key=lambda s: int(s["session_id"]))
+        rows = heapq.merge(rows, archived, key=lambda s: int(s["session_id"]))
+
+    last_id = None
+    for s in rows:
+        session_id = int(s["session_id"])
+        if session_id == last_id:
+            continue  # archived while we were reading: present in both tiers
+        last_id = session_id
+        if after_id is not None and session_id <= after_id:
+            continue
+        created_at = s.get("created_at") or ""
+        if created_from and created_at[:len(created_from)] < created_from:
+            continue
+        if created_to and created_at[:len(created_to)] > created_to:
+            continue
+        if intent_lower and intent_lower not in (s.get("intent") or "").lower():
+            continue
+        yield s
+
+def get_shopping_sessions_by_user_id(user_id, limit=None, after=None, created_from=None, created_to=None, intent=None,
+                                     include_archived=True):
+    """
+    Retrieve the shopping sessions associated with the given user_id.
+    Returns a list of session dictionaries, at most `limit` of them.
+    See iter_shopping_sessions_by_user_id for the filter arguments.
+    """
+    sessions = iter_shopping_sessions_by_user_id(
+        user_id, after=after, created_from=created_from, created_to=created_to, intent=intent,
+        include_archived=include_archived
+    )
+    try:
+        with observe_storage(_table_name(SESSIONS_CSV), "read"):
+            return list(islice(sessions, limit) if limit is not None else sessions)
+    finally:
+        sessions.close()
 
 
 # ------------------------------------------------------------------------------
 # PRODUCT PAGES
 # ------------------------------------------------------------------------------
-def load_product_pages():
+def load_product_pages(session_id=None):
     # Let DictReader infer the header from the first row in the file
-    return load_csv(PRODUCT_PAGES_CSV, fieldnames=None)
+    return _load_table(PRODUCT_PAGES_CSV, key=session_id)
 
-def save_product_pages(pages_list):
+def save_product_pages(pages_list, session_id=None):
     # Use explicit fieldnames when saving
-    fieldnames = ["session_id", "product_page"]
-    save_csv(PRODUCT_PAGES_CSV, pages_list, fieldnames)
+    fieldnames = ["session_id", "product_page", "source_hash"]
+    _save_table(PRODUCT_PAGES_CSV, pages_list, fieldnames, key=session_id)
+
+# Callables invoked with each record stored by add_product_page (e.g. the product search index).
+product_page_listeners = []
 
-def add_product_page(session_id, product_page):
-    pages = load_product_pages()  # will read properly with no repeated header
+@_locked
+def add_product_page(session_id, product_page, source_hash=""):
+    """
+    Stores a product description for the session. `source_hash` identifies the
+    product page it was generated from, so the same page can be recognized later.
+    """
+    pages = load_product_pages(session_id)  # will read properly with no repeated header
     new_record = {
         "session_id": str(session_id),
-        "product_page": str(product_page)
+        "product_page": str(product_page),
+        "source_hash": source_hash or "",
     }
     pages.append(new_record)
-    save_product_pages(pages)
+    save_product_pages(pages, session_id)
+    invalidate_comparison(session_id)
+    for listener in product_page_listeners:
+        listener(new_record)
     return new_record
 
 def get_product_pages_by_session_id(session_id):
-    pages = load_product_pages()
-    return [p for p in pages if p["session_id"] == str(session_id)]
+    pages = load_product_pages(session_id)
+    pages = [p for p in pages if p["session_id"] == str(session_id)]
+    if archive.is_archived(session_id):
+        # Pages added after the session was archived stay in the hot table.
+        pages = archive.get_archived_product_pages(session_id) + pages
+    return pages
+
+
+# ------------------------------------------------------------------------------
+# LOCAL CHAT HISTORY
+# ------------------------------------------------------------------------------
+CHAT_MESSAGE_FIELDNAMES = ["message_id", "thread_id", "role", "content", "created_at"]
+
+def load_chat_messages(thread_id=None):
+    """
+    Load locally stored chat messages (used by the "completions" engine).
+    Returns a list of dicts with keys:
+      ['message_id', 'thread_id', 'role', 'content', 'created_at']
+    """
+    return _load_table(CHAT_MESSAGES_CSV, key=thread_id)
+
+def save_chat_messages(rows, thread_id=None):
+    _save_table(CHAT_MESSAGES_CSV, rows, CHAT_MESSAGE_FIELDNAMES, key=thread_id)
+
+def get_chat_messages(thread_id):
+    """
+    Returns the stored messages of a thread, oldest first, including those
+    archived with its session.
+    """
+    messages = [m for m in load_chat_messages(thread_id) if m["thread_id"] == str(thread_id)]
+    archived_session_id = archive.archived_session_for_thread(thread_id)
+    if archived_session_id is not None:
+        # Messages added after the session was archived stay in the hot table.
+        messages = archive.get_archived_chat_messages(archived_session_id) + messages
+    return messages
+
+@_locked
+def add_chat_messages(thread_id, messages):
+    """
+    Appends messages (dicts with message_id, role, content, created_at) to a thread.
+    """
+    rows = load_chat_messages(thread_id)
+    for message in messages:
+        rows.append({
+            "message_id": message["message_id"],
+            "thread_id": str(thread_id),
+            "role": message["role"],
+            "content": message["content"],
+            "created_at": str(message["created_at"]),
+        })
+    save_chat_messages(rows, thread_id)
+
+
+# ------------------------------------------------------------------------------
+# PREFERENCE EXTRACTION WATERMARKS
+# ------------------------------------------------------------------------------
+def load_extraction_watermarks():
+    """
+    Load extraction watermarks from CSV.
+    Returns a list of dicts with keys:
+      ['session_id', 'last_message_id', 'updated_at']
+    """
+    return load_csv(EXTRACTIONS_CSV)
+
+def save_extraction_watermarks(rows):
+    fieldnames = ["session_id", "last_message_id", "updated_at"]
+    save_csv(EXTRACTIONS_CSV, rows, fieldnames)
+
+def get_extraction_watermark(session_id):
+    """
+    Returns the ID of the last thread message already processed by preference
+    extraction for this session, or None if the session was never extracted.
+    """
+    for row in load_extraction_watermarks():
+        if row["session_id"] == str(session_id):
+            return row["last_message_id"] or None
+    if archive.is_archived(session_id):
+        archived = archive.get_archived_extraction(session_id)
+        return (archived or {}).get("last_message_id") or None
+    return None
+
+@_locked
+def set_extraction_watermark(session_id, last_message_id):
+    """
+    Records `last_message_id` as the extraction high-water mark of the session.
+    """
+    rows = load_extraction_watermarks()
+    now_str = datetime.now().isoformat()
+    for row in rows:
+        if row["session_id"] == str(session_id):
+            row["last_message_id"] = last_message_id
+            row["updated_at"] = now_str
+            break
+    else:
+        rows.append({
+            "session_id": str(session_id),
+            "last_message_id": last_message_id,
+            "updated_at": now_str
+        })
+    save_extraction_watermarks(rows)
+
+
+# ------------------------------------------------------------------------------
+# CACHED COMPARISON RESULTS
+# ------------------------------------------------------------------------------
+# One row per session, sharded by session_id like the product pages, so the
+# hot /messages and add_product_page paths only read the session's own shard.
+COMPARISON_FIELDNAMES = ["session_id", "epoch", "pages_hash", "result", "created_at"]
+
+def load_comparisons(session_id=None):
+    """
+    Load cached comparison results from CSV (only the shard of `session_id`
+    when sharded). Returns a list of dicts with keys:
+      ['session_id', 'epoch', 'pages_hash', 'result', 'created_at']
+    `result` is the JSON-encoded comparison; it is empty after an invalidation.
+    """
+    # Rows written before the schema lost its "version" and "last_message_id"
+    # columns are narrowed to it.
+    return [{k: r.get(k) or "" for k in COMPARISON_FIELDNAMES} for r in _load_table(COMPARISONS_CSV, session_id)]
+
+def save_comparisons(rows, session_id=None):
+    """
+    Save comparison rows. Pass the `session_id` used to load a single shard.
+    """
+    _save_table(COMPARISONS_CSV, rows, COMPARISON_FIELDNAMES, key=session_id)
+
+def get_comparison(session_id):
+    """
+    Returns the comparison row of the session, or None if it has none.
+    Unlike begin_comparison() this never writes.
+    """
+    for row in load_comparisons(session_id):
+        if row["session_id"] == str(session_id):
+            return row
+    return None
+
+@_locked
+def begin_comparison(session_id):
+    """
+    Returns the comparison row of the session, creating an empty one first if
+    the session has none. A comparison that is about to run records the row's
+    epoch and passes it to set_comparison().
+    """
+    rows = load_comparisons(session_id)
+    for row in rows:
+        if row["session_id"] == str(session_id):
+            return row
+    row = {"session_id": str(session_id), "epoch": "0", "pages_hash": "", "result": "", "created_at": ""}
+    rows.append(row)
+    save_comparisons(rows, session_id)
+    return dict(row)
+
+@_locked
+def invalidate_comparison(session_id):
+    """
+    Drops the cached comparison of the session and bumps its epoch, so that a
+    comparison that was already running when the inputs changed is not stored.
+    Sessions that never ran a comparison have no row and cost no write.
+    """
+    rows = load_comparisons(session_id)
+    for row in rows:
+        if row["session_id"] == str(session_id):
+            row["epoch"] = str(int(row["epoch"] or 0) + 1)
+            row.update(pages_hash="", result="", created_at="")
+            save_comparisons(rows, session_id)
+            return
+
+@_locked
+def set_comparison(session_id, epoch, pages_hash, result):
+    """
+    Stores a comparison computed from inputs read at `epoch`. Returns False
+    (and stores nothing) if the session was invalidated in the meantime.
+    """
+    rows = load_comparisons(session_id)
+    row = next((r for r in rows if r["session_id"] == str(session_id)), None)
+    if row is None or row["epoch"] != str(epoch):
+        return False
+    row.update(
+        pages_hash=pages_hash,
+        result=result,
+        created_at=datetime.now().isoformat(),
+    )
+    save_comparisons(rows, session_id)
+    return True
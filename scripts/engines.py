@@ -0,0 +1,276 @@
+# engines.py
+"""
+Execution engines behind the agents.
+
+"assistants" (the default) runs each request on an Assistants API thread:
+create a thread and message, create_and_poll a run, then list the messages.
+
+"completions" sends the whole prompt in one streamed chat.completions call
+and keeps chat history in the local chat_messages table, so a turn costs a
+single request. It uses the model and instructions configured on the
+agent's assistant, read once per process.
+
+Select the engine per agent with CHAT_ENGINE, DESCRIPTION_ENGINE and
+COMPARISON_ENGINE.
+"""
+import os
+import threading
+import time
+import uuid
+
+from scripts.csv_db import add_chat_messages, get_chat_messages
+from scripts.logging_utils import get_logger, fields
+from scripts.metrics import observe_openai, record_token_usage
+
+log = get_logger("engines")
+
+ENGINES = ("assistants", "completions")
+# Model used by the completions engine when the agent has no assistant to copy it from.
+COMPLETIONS_MODEL = os.getenv("COMPLETIONS_MODEL", "gpt-4o-mini")
+# Threads created for the completions engine live only in the local store.
+LOCAL_THREAD_PREFIX = "local_"
+# Messages listed per thread by default (the Assistants API default page size).
+RECENT_MESSAGES = 20
+
+
+def engine_for(agent_env_name):
+    """
+    Returns the engine configured in the environment variable `agent_env_name`
+    (e.g. "CHAT_ENGINE"), defaulting to "assistants".
+    """
+    engine = os.getenv(agent_env_name, "assistants").lower()
+    if engine not in ENGINES:
+        raise ValueError(f"{agent_env_name} must be one of {ENGINES}, got {engine!r}")
+    return engine
+
+
+def new_message_id():
+    return f"lmsg_{uuid.uuid4().hex}"
+
+
+def new_local_thread_id():
+    return f"{LOCAL_THREAD_PREFIX}{uuid.uuid4().hex}"
+
+
+def is_local_thread(thread_id):
+    return str(thread_id).startswith(LOCAL_THREAD_PREFIX)
+
+
+def message_dict(message_id, role, created_at, content):
+    """
+    The message shape every agent returns.
+    """
+    return {"id": message_id, "role": role, "created_at": created_at, "content": content}
+
+
+def _text_of(msg):
+    return "".join(item.text.value for item in msg.content if item.type == "text")
+
+
+# ------------------------------------------------------------------------------
+# 1. TRANSCRIPTS
+# ------------------------------------------------------------------------------
+def _local_messages(thread_id):
+    return [
+        message_dict(row["message_id"], row["role"], int(row["created_at"]), row["content"])
+        for row in get_chat_messages(thread_id)
+    ]
+
+
+def _reads_local(thread_id):
+    """
+    True if the thread's history lives in the local store: local threads, and
+    Assistants threads while the chat engine is "completions" (which copies
+    them on their first turn). With CHAT_ENGINE=assistants the Assistants
+    thread is the current one, even if an earlier copy exists locally.
+    """
+    return is_local_thread(thread_id) or engine_for("CHAT_ENGINE") == "completions"
+
+
+def recent_messages(client, thread_id, agent):
+    """
+    Returns the most recent messages of the conversation, newest first, like
+    a default messages.list. Reads the local history when the thread has one
+    (the completions chat engine), otherwise the Assistants thread.
+    """
+    local = _local_messages(thread_id) if _reads_local(thread_id) else []
+    if local or is_local_thread(thread_id):
+        return local[::-1][:RECENT_MESSAGES]
+    with observe_openai(agent, "message_list"):
+        response = client.beta.threads.messages.list(thread_id=thread_id)
+    return [message_dict(m.id, m.role, m.created_at, _text_of(m)) for m in response.data]
+
+
+def messages_after(client, thread_id, after, agent):
+    """
+    Returns every message added after message `after` (all if None), oldest
+    first, following the Assistants cursor across pages when needed.
+    """
+    local = _local_messages(thread_id) if _reads_local(thread_id) else []
+    if local or is_local_thread(thread_id):
+        ids = [m["id"] for m in local]
+        return local[ids.index(after) + 1:] if after in ids else local
+
+    messages = []
+    while True:
+        kwargs = {"thread_id": thread_id, "order": "asc", "limit": 100}
+        if after:
+            kwargs["after"] = after
+        with observe_openai(agent, "message_list"):
+            page = client.beta.threads.messages.list(**kwargs)
+        messages.extend(message_dict(m.id, m.role, m.created_at, _text_of(m)) for m in page.data)
+        if not page.data or not getattr(page, "has_more", False):
+            return messages
+        after = page.data[-1].id
+
+
+# ------------------------------------------------------------------------------
+# 2. ENGINES
+# ------------------------------------------------------------------------------
+class AssistantsEngine:
+    """
+    Runs a prompt on a fresh Assistants API thread.
+
+    Args:
+        client: OpenAI client.
+        assistant_id (str): The assistant to run.
+        agent (str): Agent name for metrics.
+    """
+    name = "assistants"
+
+    def __init__(self, client, assistant_id, agent):
+        self.client = client
+        self.assistant_id = assistant_id
+        self.agent = agent
+
+    def run_prompt(self, prompt, assistant_only=False, **run_kwargs):
+        """
+        Returns the messages of the new thread (newest first), or {"status": ...}
+        if the run did not complete. With assistant_only the prompt message
+        itself is left out.
+        """
+        with observe_openai(self.agent, "thread_create"):
+            thread = self.client.beta.threads.create()
+        with observe_openai(self.agent, "message_create"):
+            self.client.beta.threads.messages.create(thread_id=thread.id, role="user", content=prompt)
+        with observe_openai(self.agent, "run"):
+            run = self.client.beta.threads.runs.create_and_poll(
+                thread_id=thread.id, assistant_id=self.assistant_id, **run_kwargs
+            )
+        record_token_usage(self.agent, getattr(run, "usage", None))
+        if run.status != "completed":
+            return {"status": run.status}
+        with observe_openai(self.agent, "message_list"):
+            response = self.client.beta.threads.messages.list(thread_id=thread.id)
+        return [
+            message_dict(m.id, m.role, m.created_at, _text_of(m))
+            for m in response.data
+            if not assistant_only or m.role == "assistant"
+        ]
+
+
+class CompletionsEngine:
+    """
+    Answers with a single streamed chat.completions call. The model and the
+    system instructions are taken from the agent's assistant (fetched once).
+
+    Args:
+        client: OpenAI client.
+        assistant_id (str): Assistant whose model and instructions to use; may be None.
+        agent (str): Agent name for metrics.
+    """
+    name = "completions"
+
+    def __init__(self, client, assistant_id, agent):
+        self.client = client
+        self.assistant_id = assistant_id
+        self.agent = agent
+        self._config = None
+        self._config_lock = threading.Lock()
+
+    def _model_and_instructions(self):
+        with self._config_lock:
+            if self._config is None:
+                model, instructions = COMPLETIONS_MODEL, ""
+                if self.assistant_id:
+                    with observe_openai(self.agent, "assistant_retrieve"):
+                        assistant = self.client.beta.assistants.retrieve(self.assistant_id)
+                    model = assistant.model or model
+                    instructions = assistant.instructions or ""
+                self._config = (model, instructions)
+            return self._config
+
+    def complete(self, messages, instructions=None):
+        """
+        Streams a completion for `messages` (without the system message, which
+        is added here) and returns the full text. `instructions` overrides the
+        assistant's instructions, like the run parameter of the same name.
+        """
+        model, default_instructions = self._model_and_instructions()
+        if instructions is None:
+            instructions = default_instructions
+        if instructions:
+            messages = [{"role": "system", "content": instructions}] + list(messages)
+        parts = []
+        usage = None
+        with observe_openai(self.agent, "chat_completion"):
+            stream = self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for chunk in stream:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage
+        record_token_usage(self.agent, usage)
+        return "".join(parts)
+
+    def run_prompt(self, prompt, assistant_only=False, instructions=None):
+        """
+        Same return shape as AssistantsEngine.run_prompt. The prompt and the
+        reply are not stored anywhere.
+        """
+        prompt_message = message_dict(new_message_id(), "user", int(time.time()), prompt)
+        reply_text = self.complete([{"role": "user", "content": prompt}], instructions=instructions)
+        reply = message_dict(new_message_id(), "assistant", int(time.time()), reply_text)
+        return [reply] if assistant_only else [reply, prompt_message]
+
+    def chat_turn(self, thread_id, user_message):
+        """
+        Appends `user_message` to the locally stored thread, answers it with the
+        whole history as context and stores the reply. A thread created for the
+        Assistants engine is copied into the local store on its first turn.
+
+        Returns:
+            list: The thread's most recent messages, newest first.
+        """
+        history = _local_messages(thread_id)
+        to_store = []
+        if not history and not is_local_thread(thread_id):
+            history = messages_after(self.client, thread_id, None, self.agent)
+            to_store.extend(history)
+            log.info("Copied chat history to local store", extra=fields(thread_id=thread_id, messages=len(history)))
+
+        user = message_dict(new_message_id(), "user", int(time.time()), user_message)
+        history.append(user)
+        to_store.append(user)
+        reply_text = self.complete([{"role": m["role"], "content": m["content"]} for m in history])
+        reply = message_dict(new_message_id(), "assistant", int(time.time()), reply_text)
+        history.append(reply)
+        to_store.append(reply)
+
+        add_chat_messages(thread_id, [
+            {"message_id": m["id"], "role": m["role"], "content": m["content"], "created_at": m["created_at"]}
+            for m in to_store
+        ])
+        return history[::-1][:RECENT_MESSAGES]
+
+
+def make_engine(engine, client, assistant_id, agent):
+    cls = CompletionsEngine if engine == "completions" else AssistantsEngine
+    return cls(client, assistant_id, agent)
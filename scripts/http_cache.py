@@ -0,0 +1,110 @@
+# http_cache.py
+import gzip
+import hashlib
+import os
+
+from flask import jsonify, request
+
+try:
+    import brotli  # Optional: pip install brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are sent uncompressed; the headers would eat the gain.
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/plain", "text/markdown", "text/html", "text/csv"}
+
+# Suffixes added to the ETag of compressed representations, so each encoding
+# keeps its own strong validator.
+_ENCODING_SUFFIXES = {"gzip": "-gzip", "br": "-br"}
+
+
+# ------------------------------------------------------------------------------
+# 1. ETAG / CONDITIONAL GET
+# ------------------------------------------------------------------------------
+def compute_etag(body):
+    """
+    Strong ETag for a response body: the first 32 hex chars of its SHA-256.
+    """
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+def _matching_etag(etag):
+    """
+    Returns the variant of `etag` (plain or encoding-suffixed) the client sent
+    in If-None-Match, or None.
+    """
+    if_none_match = request.if_none_match
+    if not if_none_match:
+        return None
+    for suffix in ("",) + tuple(_ENCODING_SUFFIXES.values()):
+        if if_none_match.contains(etag + suffix):
+            return etag + suffix
+    return None
+
+
+def conditional_json(payload, status=200):
+    """
+    Returns `payload` as a JSON response carrying a strong ETag derived from the
+    serialized rows. If the client already holds that representation
+    (If-None-Match), an empty 304 Not Modified is returned instead.
+    """
+    response = jsonify(payload)
+    response.status_code = status
+    etag = compute_etag(response.get_data())
+    response.set_etag(etag)
+    matched = _matching_etag(etag) if status == 200 else None
+    if matched:
+        response.status_code = 304
+        response.set_etag(matched)
+        response.set_data(b"")
+    return response
+
+
+# ------------------------------------------------------------------------------
+# 2. RESPONSE COMPRESSION
+# ------------------------------------------------------------------------------
+def _pick_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress_response(response):
+    """
+    after_request hook that gzip/brotli-encodes large text and JSON bodies
+    when the client accepts it.
+    """
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = _pick_encoding()
+    if encoding is None:
+        return response
+
+    if encoding == "br":
+        compressed = brotli.compress(body, quality=min(COMPRESS_LEVEL, 11))
+    else:
+        compressed = gzip.compress(body, compresslevel=COMPRESS_LEVEL)
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag + _ENCODING_SUFFIXES[encoding])
+    return response
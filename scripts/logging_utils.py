@@ -0,0 +1,197 @@
+# logging_utils.py
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # "json" or "text"
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "512"))
+LOG_MAX_FIELD_ITEMS = int(os.getenv("LOG_MAX_FIELD_ITEMS", "20"))
+# Fraction of DEBUG/INFO records that are kept. WARNING and above are always kept.
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+# Keys whose values must never reach the logs.
+REDACTED_KEYS = {"password", "api_key", "token", "authorization", "secret"}
+
+_setup_lock = threading.Lock()
+_listener = None
+
+
+# ------------------------------------------------------------------------------
+# 1. PAYLOAD SUMMARIZING
+# ------------------------------------------------------------------------------
+def summarize(value, max_chars=None, max_items=None, _depth=0):
+    """
+    Returns a size-capped, redacted copy of `value` that is safe to log.
+    Long strings are cut to `max_chars`, long lists/dicts to `max_items`
+    entries, and values stored under sensitive keys are replaced.
+    """
+    max_chars = LOG_MAX_FIELD_CHARS if max_chars is None else max_chars
+    max_items = LOG_MAX_FIELD_ITEMS if max_items is None else max_items
+
+    if isinstance(value, str):
+        if len(value) > max_chars:
+            return value[:max_chars] + f"...[{len(value) - max_chars} more chars]"
+        return value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if _depth >= 4:
+        return f"<{type(value).__name__}>"
+    if isinstance(value, dict):
+        out = {}
+        for i, (k, v) in enumerate(value.items()):
+            if i >= max_items:
+                out["..."] = f"{len(value) - max_items} more keys"
+                break
+            if str(k).lower() in REDACTED_KEYS:
+                out[k] = "***"
+            else:
+                out[k] = summarize(v, max_chars, max_items, _depth + 1)
+        return out
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        out = [summarize(v, max_chars, max_items, _depth + 1) for v in items[:max_items]]
+        if len(items) > max_items:
+            out.append(f"...[{len(items) - max_items} more items]")
+        return out
+    return summarize(str(value), max_chars, max_items, _depth + 1)
+
+
+def fields(**kwargs):
+    """
+    Helper for attaching structured fields to a log call:
+        log.info("User created", extra=fields(user_id=user_id))
+    """
+    return {"fields": kwargs}
+
+
+# ------------------------------------------------------------------------------
+# 2. FORMATTERS, FILTERS AND HANDLERS
+# ------------------------------------------------------------------------------
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single JSON line with any structured fields merged in.
+    """
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Human readable formatter used for local development (LOG_FORMAT=text).
+    """
+    def format(self, record):
+        line = super().format(record)
+        extra = getattr(record, "fields", None)
+        if extra:
+            line += " " + " ".join(f"{k}={json.dumps(v, default=str)}" for k, v in extra.items())
+        return line
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of records below WARNING so chatty endpoints can be
+    logged under load without flooding the output.
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+
+class SummarizingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that caps the structured fields before the record is handed
+    to the listener thread. Request threads only pay for a cheap shallow copy;
+    serialization and I/O happen on the listener thread.
+    """
+    def prepare(self, record):
+        record = super().prepare(record)
+        if getattr(record, "fields", None):
+            record.fields = summarize(record.fields)
+        return record
+
+
+# ------------------------------------------------------------------------------
+# 3. SETUP
+# ------------------------------------------------------------------------------
+def setup_logging():
+    """
+    Configures the "ppd" logger hierarchy once per process. Records are pushed
+    onto an in-memory queue and written to stdout by a background listener.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+
+        stream_handler = logging.StreamHandler(sys.stdout)
+        if LOG_FORMAT == "text":
+            stream_handler.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        else:
+            stream_handler.setFormatter(JsonFormatter())
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = SummarizingQueueHandler(log_queue)
+        queue_handler.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
+
+        root = logging.getLogger("ppd")
+        root.setLevel(LOG_LEVEL)
+        root.addHandler(queue_handler)
+        root.propagate = False
+
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """
+    Flushes any queued records and stops the listener thread.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def _restart_listener_after_fork():
+    # Threads do not survive fork(): a worker forked from a preloaded gunicorn
+    # master inherits the listener object but not its thread, so start a new one.
+    global _setup_lock
+    _setup_lock = threading.Lock()
+    if _listener is not None:
+        _listener._thread = None
+        _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_listener_after_fork)
+
+
+def get_logger(name):
+    """
+    Returns a logger under the "ppd" hierarchy, configuring logging on first use.
+    """
+    setup_logging()
+    return logging.getLogger(f"ppd.{name}")
@@ -0,0 +1,242 @@
+# metrics.py
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from scripts.tracing import span
+
+# Latency buckets in seconds. OpenAI runs routinely take several seconds, so the
+# upper buckets go well past what a CSV read or a cached response would need.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+# ------------------------------------------------------------------------------
+# 1. METRIC TYPES
+# ------------------------------------------------------------------------------
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [per-bucket counts..., +Inf count], sum
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager that observes the wall time of its block in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_sample(self, key, state):
+        counts, total = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# ------------------------------------------------------------------------------
+# 2. REGISTRY
+# ------------------------------------------------------------------------------
+_registry = []
+
+
+def register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render_metrics():
+    """
+    Returns every registered metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ------------------------------------------------------------------------------
+# 3. APPLICATION METRICS
+# ------------------------------------------------------------------------------
+HTTP_REQUESTS = register(Counter(
+    "http_requests_total", "HTTP requests handled, by route.",
+    ("endpoint", "method", "status"),
+))
+HTTP_LATENCY = register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency, by route.",
+    ("endpoint", "method"),
+))
+OPENAI_LATENCY = register(Histogram(
+    "openai_operation_duration_seconds", "Latency of OpenAI API operations, by agent.",
+    ("agent", "operation"),
+))
+OPENAI_ERRORS = register(Counter(
+    "openai_operation_errors_total", "OpenAI API operations that raised, by agent.",
+    ("agent", "operation"),
+))
+OPENAI_TOKENS = register(Counter(
+    "openai_tokens_total", "Tokens reported by OpenAI usage, by agent.",
+    ("agent", "kind"),
+))
+COMPARISON_CACHE = register(Counter(
+    "comparison_cache_total", "Comparison requests answered from the per-session cache (hit) or by a new run (miss).",
+    ("result",),
+))
+DESCRIPTION_LOOKUPS = register(Counter(
+    "description_lookups_total",
+    "Product description requests by outcome: reused (no generation), grounded or generated.",
+    ("outcome",),
+))
+STORAGE_LATENCY = register(Histogram(
+    "storage_operation_duration_seconds", "CSV storage read/write latency, by table.",
+    ("table", "operation"),
+))
+
+
+@contextmanager
+def observe_storage(table, operation):
+    """
+    Times a storage read/write and records it as a "storage.<operation>" span.
+    """
+    with span(f"storage.{operation}", table=table), STORAGE_LATENCY.time(table=table, operation=operation):
+        yield
+
+
+@contextmanager
+def observe_openai(agent, operation):
+    """
+    Times an OpenAI call and counts it as an error if it raises. The call is
+    also recorded as an "openai.<operation>" span on the active trace.
+        with observe_openai("ChatAgent", "run"):
+            run = client.beta.threads.runs.create_and_poll(...)
+    """
+    start = time.perf_counter()
+    try:
+        with span(f"openai.{operation}", agent=agent):
+            yield
+    except Exception:
+        OPENAI_ERRORS.inc(agent=agent, operation=operation)
+        raise
+    finally:
+        OPENAI_LATENCY.observe(time.perf_counter() - start, agent=agent, operation=operation)
+
+
+def record_token_usage(agent, usage):
+    """
+    Adds the prompt/completion/cached token counts of a run or completion to the
+    per-agent counters. `usage` may be None (e.g. for runs that did not complete).
+    """
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    # Prompt tokens served from OpenAI's prompt cache (a subset of prompt_tokens).
+    details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "prompt_token_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    OPENAI_TOKENS.inc(prompt_tokens, agent=agent, kind="prompt")
+    OPENAI_TOKENS.inc(completion_tokens, agent=agent, kind="completion")
+    OPENAI_TOKENS.inc(cached_tokens, agent=agent, kind="cached")
@@ -0,0 +1,177 @@
+# product_index.py
+"""
+In-memory BM25 index over every stored product description, across sessions.
+
+The index is built from the product pages table on first use and then kept up
+to date by add_product_page. Pages written by another process (another
+gunicorn worker) are picked up by a rebuild when the table files change.
+"""
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+from scripts import csv_db
+from scripts.logging_utils import get_logger, fields
+from scripts.metrics import Counter as MetricCounter, register
+
+log = get_logger("product_index")
+
+# BM25 parameters: term-frequency saturation and document-length normalization.
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Long queries (a whole product page) are cut to their most selective terms.
+MAX_QUERY_TERMS = 64
+
+PRODUCT_INDEX_REBUILDS = register(MetricCounter(
+    "product_index_rebuilds_total", "Full rebuilds of the product search index.",
+))
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+_STOP_WORDS = frozenset("""
+a an and are as at be but by for from has have in is it its of on or that the this to was
+were will with you your our we they their it's can all more than into also these those
+""".split())
+
+
+def tokenize(text):
+    return [t for t in _TOKEN_RE.findall((text or "").lower()) if len(t) > 1 and t not in _STOP_WORDS]
+
+
+def page_source_hash(product_page):
+    """
+    Identifies a raw product page, to recognize a page that was described before.
+    """
+    return hashlib.sha256((product_page or "").encode("utf-8")).hexdigest()
+
+
+def _source_stamp():
+    paths = [csv_db.PRODUCT_PAGES_CSV]
+    if csv_db.is_sharded():
+        paths = csv_db._all_shard_paths(csv_db.PRODUCT_PAGES_CSV)
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamp.append((path, st.st_size, st.st_mtime_ns))
+        except OSError:
+            stamp.append((path, None, None))
+    return tuple(stamp)
+
+
+class ProductIndex:
+    """
+    BM25 inverted index of product descriptions.
+
+    Each document is one product_pages row: {"session_id", "product_page",
+    "source_hash"}. Postings map a term to {doc_id: term frequency}.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._built = False
+        self._stamp = None
+        self._reset()
+
+    def _reset(self):
+        self._docs = []
+        self._lengths = []
+        self._total_length = 0
+        self._postings = {}
+        self._by_source = {}  # source_hash -> [doc_id, ...]
+
+    def _add_locked(self, record):
+        doc_id = len(self._docs)
+        terms = Counter(tokenize(record.get("product_page", "")))
+        self._docs.append(record)
+        length = sum(terms.values())
+        self._lengths.append(length)
+        self._total_length += length
+        for term, tf in terms.items():
+            self._postings.setdefault(term, {})[doc_id] = tf
+        if record.get("source_hash"):
+            self._by_source.setdefault(record["source_hash"], []).append(doc_id)
+
+    def rebuild(self):
+        rows = csv_db.load_product_pages()
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self._add_locked(row)
+            self._built = True
+            self._stamp = _source_stamp()
+        PRODUCT_INDEX_REBUILDS.inc()
+        log.info("Product index built", extra=fields(documents=len(rows), terms=len(self._postings)))
+
+    def _ensure_current(self):
+        if not self._built:
+            self.rebuild()
+        elif not csv_db.CSV_WRITE_BEHIND and _source_stamp() != self._stamp:
+            # Another process stored pages. (With write-behind there is a
+            # single process and the files lag behind the index, so skip this.)
+            self.rebuild()
+
+    def add(self, record):
+        """
+        Indexes a newly stored product_pages row. Registered as an
+        add_product_page listener.
+        """
+        with self._lock:
+            if not self._built:
+                return  # the first search builds the index from the table, this row included
+            self._add_locked(dict(record))
+            self._stamp = _source_stamp()
+
+    def search(self, query, limit=10, exclude_session_id=None, session_ids=None):
+        """
+        Returns the best matching documents as [(score, record), ...], best first.
+        `session_ids` restricts the results to those sessions; documents of
+        `exclude_session_id` are left out.
+        """
+        self._ensure_current()
+        with self._lock:
+            n_docs = len(self._docs)
+            if not n_docs:
+                return []
+            avg_length = self._total_length / n_docs or 1.0
+            idf = {}
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if postings:
+                    df = len(postings)
+                    idf[term] = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            terms = sorted(idf, key=idf.get, reverse=True)[:MAX_QUERY_TERMS]
+
+            scores = {}
+            for term in terms:
+                weight = idf[term]
+                for doc_id, tf in self._postings[term].items():
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf * (BM25_K1 + 1) / (tf + norm)
+
+            if session_ids is not None:
+                allowed = {str(sid) for sid in session_ids}
+                scores = {d: sc for d, sc in scores.items() if self._docs[d]["session_id"] in allowed}
+            if exclude_session_id is not None:
+                scores = {d: sc for d, sc in scores.items()
+                          if self._docs[d]["session_id"] != str(exclude_session_id)}
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+            return [(round(score, 4), dict(self._docs[doc_id])) for doc_id, score in best]
+
+    def find_by_source(self, source_hash, session_id=None):
+        """
+        Returns the most recent record generated from the product page with
+        `source_hash` (only from `session_id` if given), or None.
+        """
+        self._ensure_current()
+        with self._lock:
+            for doc_id in reversed(self._by_source.get(source_hash, [])):
+                record = self._docs[doc_id]
+                if session_id is None or record["session_id"] == str(session_id):
+                    return dict(record)
+        return None
+
+
+product_index = ProductIndex()
+csv_db.product_page_listeners.append(product_index.add)
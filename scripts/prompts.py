@@ -0,0 +1,141 @@
+# prompts.py
+"""
+Prompt texts and a builder that assembles them in a cache-friendly order.
+
+OpenAI caches prompt prefixes (from 1024 tokens on): a request whose prompt
+starts with the same tokens as a recent one skips recomputing them, which is
+cheaper and lowers time-to-first-token. Each prompt is therefore laid out as
+
+    static instructions      identical for every request of an agent
+    stable context           identical across requests of one user/session
+    variable input           different on every request
+
+so the longest possible prefix repeats between calls.
+"""
+from scripts.logging_utils import get_logger, fields
+from scripts.metrics import Counter, register
+
+log = get_logger("prompts")
+
+PROMPT_CHARS = register(Counter(
+    "prompt_chars_total", "Characters sent in prompts, by agent and part (cacheable prefix or variable).",
+    ("agent", "part"),
+))
+
+SECTION_SEPARATOR = "\n\n"
+
+
+# ------------------------------------------------------------------------------
+# 1. STATIC INSTRUCTIONS
+# ------------------------------------------------------------------------------
+DESCRIPTION_INSTRUCTIONS = (
+    "Create a tailored product description for this user, based on the pre-shopping "
+    "conversation and the product page below."
+)
+
+COMPARISON_INSTRUCTIONS = (
+    "Below are a pre-shopping conversation with the user and the descriptions of the products "
+    "they looked at. Remove duplicates and pick at most 4 products that best match user needs "
+    "to create a comparison table for them."
+)
+
+EXTRACTION_SYSTEM_PROMPT = (
+    "You are an expert at extracting structured user preferences from conversation text.\n "
+    "Given the conversation below, extract any key user preferences or insights.\n"
+    "Return your result following the provided structure.\n"
+    "Some examples of user information you might extract from a conversation:\n"
+    "{\n"
+    '  "preferences": [\n'
+    '    {"key": "Marital Status", "value": "Married"},\n'
+    '    {"key": "Career", "value": "Graphic Designer"},\n'
+    '    {"key": "Interests", "value": "Digital Design, Travel Documentaries, Baking"},\n'
+    '    {"key": "Tech Savviness", "value": "High"}\n'
+    "  ]\n"
+    "}\n\n"
+)
+
+
+# ------------------------------------------------------------------------------
+# 2. BUILDER
+# ------------------------------------------------------------------------------
+class Prompt:
+    """
+    An assembled prompt.
+
+    Attributes:
+        static (str): Agent-wide instructions.
+        stable (str): Per-user/session context.
+        variable (str): Per-request input.
+        text (str): The three parts joined, in that order.
+        cacheable_prefix_chars (int): Length of the text up to and including
+            the stable context, i.e. the part that can repeat between requests.
+    """
+    def __init__(self, static, stable, variable):
+        self.static = static
+        self.stable = stable
+        self.variable = variable
+        prefix = SECTION_SEPARATOR.join(part for part in (static, stable) if part)
+        self.text = SECTION_SEPARATOR.join(part for part in (static, stable, variable) if part)
+        self.cacheable_prefix_chars = len(prefix) + (len(SECTION_SEPARATOR) if prefix and variable else 0)
+
+    def as_chat_messages(self):
+        """
+        Returns Chat Completions messages: the static instructions as the system
+        message, the stable context followed by the variable input as the user
+        message.
+        """
+        user = SECTION_SEPARATOR.join(part for part in (self.stable, self.variable) if part)
+        return [
+            {"role": "system", "content": self.static},
+            {"role": "user", "content": user},
+        ]
+
+
+class PromptBuilder:
+    """
+    Collects the parts of a prompt and assembles them static → stable →
+    variable, whatever order the agent adds them in.
+
+        prompt = (PromptBuilder("ComparisonAgent", COMPARISON_INSTRUCTIONS)
+                  .stable(conversation_section)
+                  .variable(products_section)
+                  .build())
+    """
+    def __init__(self, agent, static=""):
+        self.agent = agent
+        self._static = [static] if static else []
+        self._stable = []
+        self._variable = []
+
+    def static(self, text):
+        if text:
+            self._static.append(text)
+        return self
+
+    def stable(self, text):
+        if text:
+            self._stable.append(text)
+        return self
+
+    def variable(self, text):
+        if text:
+            self._variable.append(text)
+        return self
+
+    def build(self):
+        prompt = Prompt(
+            SECTION_SEPARATOR.join(self._static),
+            SECTION_SEPARATOR.join(self._stable),
+            SECTION_SEPARATOR.join(self._variable),
+        )
+        variable_chars = len(prompt.text) - prompt.cacheable_prefix_chars
+        PROMPT_CHARS.inc(prompt.cacheable_prefix_chars, agent=self.agent, part="cacheable")
+        PROMPT_CHARS.inc(variable_chars, agent=self.agent, part="variable")
+        log.debug("Prompt built", extra=fields(
+            agent=self.agent,
+            prompt_chars=len(prompt.text),
+            cacheable_prefix_chars=prompt.cacheable_prefix_chars,
+            # Rough token estimate (~4 characters per token); caching needs >= 1024.
+            cacheable_prefix_tokens_est=prompt.cacheable_prefix_chars // 4,
+        ))
+        return prompt
@@ -0,0 +1,123 @@
+# reshard.py
+"""
+Moves the preferences, sessions, product pages, chat history and comparison tables between the classic
+single-file layout and N hash-partitioned shards.
+
+Usage (with the server stopped):
+    python -m scripts.reshard --shards 8    # (re)partition into 8 shards
+    python -m scripts.reshard --shards 0    # back to single CSV files
+"""
+import argparse
+import os
+import shutil
+
+from scripts import archive, csv_db
+
+TABLE_FIELDNAMES = {
+    csv_db.PREFERENCES_CSV: ["preference_id", "user_id", "preference_key", "preference_value"],
+    csv_db.SESSIONS_CSV: ["session_id", "user_id", "thread_id", "intent", "created_at", "updated_at", "ended_at"],
+    csv_db.PRODUCT_PAGES_CSV: ["session_id", "product_page", "source_hash"],
+    csv_db.CHAT_MESSAGES_CSV: csv_db.CHAT_MESSAGE_FIELDNAMES,
+    csv_db.COMPARISONS_CSV: csv_db.COMPARISON_FIELDNAMES,
+}
+SEQUENCE_IDS = {
+    csv_db.PREFERENCES_CSV: "preference_id",
+    csv_db.SESSIONS_CSV: "session_id",
+}
+# Largest ID a table's rows hold outside the table (archived sessions), so a
+# reseeded sequence never reuses one.
+ARCHIVED_IDS = {
+    csv_db.SESSIONS_CSV: archive.max_session_id,
+}
+
+
+def _fieldnames(table_csv, rows):
+    # Keep any extra columns the rows carry beyond the known schema.
+    fieldnames = list(TABLE_FIELDNAMES[table_csv])
+    for row in rows:
+        for key in row:
+            if key not in fieldnames:
+                fieldnames.append(key)
+    return fieldnames
+
+
+def reshard(shard_count):
+    """
+    Reads every row through the current layout and rewrites the tables for
+    `shard_count` shards (0 = single files). The new shard directory is built
+    next to the old one and swapped in at the end.
+    """
+    tables = {table: csv_db._load_table(table) for table in TABLE_FIELDNAMES}
+    old_dir = csv_db.SHARDS_DIR
+    was_sharded = csv_db.is_sharded()
+
+    if shard_count == 0:
+        for table, rows in tables.items():
+            csv_db.save_csv(table, rows, _fieldnames(table, rows))
+        csv_db.flush_pending_writes()
+        if was_sharded:
+            shutil.rmtree(old_dir)
+        return
+
+    new_dir = old_dir + ".new"
+    if os.path.exists(new_dir):
+        shutil.rmtree(new_dir)
+
+    for table, rows in tables.items():
+        key_field = csv_db.SHARD_KEYS[table]
+        by_shard = {i: [] for i in range(shard_count)}
+        for row in rows:
+            by_shard[csv_db.shard_index(row[key_field], shard_count)].append(row)
+        fieldnames = _fieldnames(table, rows)
+        for i, shard_rows in by_shard.items():
+            path = csv_db.shard_path(table, index=i, shards_dir=new_dir)
+            csv_db._write_csv(path, shard_rows, fieldnames)
+
+    index = {i: [] for i in range(shard_count)}
+    for s in tables[csv_db.SESSIONS_CSV]:
+        index[csv_db.shard_index(s["session_id"], shard_count)].append(
+            {"session_id": s["session_id"], "user_id": s["user_id"]}
+        )
+    for i, rows in index.items():
+        path = csv_db.shard_path(csv_db.SESSION_INDEX_CSV, index=i, shards_dir=new_dir)
+        csv_db._write_csv(path, rows, csv_db.SESSION_INDEX_FIELDNAMES)
+    sequences = []
+    for table, id_field in SEQUENCE_IDS.items():
+        last_id = csv_db._max_id(tables[table], id_field)
+        if table in ARCHIVED_IDS:
+            last_id = max(last_id, ARCHIVED_IDS[table]())
+        sequences.append({"name": csv_db._table_name(table), "value": str(last_id)})
+    csv_db._write_csv(
+        os.path.join(new_dir, os.path.basename(csv_db.SEQUENCES_CSV)),
+        sequences,
+        ["name", "value"],
+    )
+    csv_db._write_csv(
+        os.path.join(new_dir, os.path.basename(csv_db.SHARD_LAYOUT_CSV)),
+        [{"shards": str(shard_count)}],
+        ["shards"],
+    )
+
+    if was_sharded:
+        shutil.rmtree(old_dir)
+    os.replace(new_dir, old_dir)
+
+    # The single-file tables are now stale; keep them as backups.
+    if not was_sharded:
+        for table in TABLE_FIELDNAMES:
+            if os.path.exists(table):
+                os.replace(table, table + ".bak")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Repartition the demo database tables.")
+    parser.add_argument("--shards", type=int, required=True, help="Number of shards (0 = single files).")
+    args = parser.parse_args()
+    if args.shards < 0:
+        parser.error("--shards must be >= 0")
+    reshard(args.shards)
+    print(f"Resharded into {args.shards} shard(s)." if args.shards else "Restored single-file tables.")
+
+
+if __name__ == "__main__":
+    main()
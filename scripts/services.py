@@ -0,0 +1,106 @@
+# services.py
+import os
+import threading
+
+from scripts import csv_db
+from scripts.assistant_helpers import (
+    ChatAgent, ProductDescriptionAgent, ComparisonAgent, PreferenceExtractionAgent
+)
+from scripts.engines import engine_for
+from scripts.logging_utils import get_logger, fields
+from scripts.product_index import product_index
+
+log = get_logger("services")
+
+_lock = threading.Lock()
+_instances = {}
+
+
+def _lazy(name, factory):
+    """
+    Returns the shared instance called `name`, building it with factory() on
+    first use. Nothing talks to OpenAI until a request (or warm_up) needs it,
+    and every object is created in the process that uses it, after any fork.
+    """
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = _instances[name] = factory()
+    return instance
+
+
+def get_openai_client():
+    def build():
+        import openai  # Deferred: importing the SDK is a noticeable part of startup.
+        log.info("Creating OpenAI client")
+        return openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY_PERS", ""))
+    return _lazy("openai_client", build)
+
+
+def chat_engine():
+    """
+    The engine of the chat agent; "completions" also keeps new threads local.
+    """
+    return engine_for("CHAT_ENGINE")
+
+
+def get_chat_agent():
+    return _lazy("chat_agent", lambda: ChatAgent(
+        get_openai_client(), os.getenv("MAIN_CHAT_ASSIST_ID"), engine=chat_engine()
+    ))
+
+
+def get_product_description_agent():
+    return _lazy("product_description_agent", lambda: ProductDescriptionAgent(
+        get_openai_client(), os.getenv("DESCRIPT_ASSIST_ID"), engine=engine_for("DESCRIPTION_ENGINE"),
+        reuse=os.getenv("DESCRIPTION_REUSE", "session"),
+        grounding=os.getenv("DESCRIPTION_GROUNDING", "0") == "1",
+        grounding_min_score=float(os.getenv("DESCRIPTION_GROUNDING_MIN_SCORE", "5.0")),
+    ))
+
+
+def get_comparison_agent():
+    return _lazy("comparison_agent", lambda: ComparisonAgent(
+        get_openai_client(), os.getenv("COMPARE_ASSIST_ID"), engine=engine_for("COMPARISON_ENGINE")
+    ))
+
+
+def get_preference_agent():
+    return _lazy("preference_agent", lambda: PreferenceExtractionAgent(get_openai_client()))
+
+
+def reset():
+    """
+    Drops every cached instance, e.g. after changing the OpenAI settings.
+    """
+    with _lock:
+        _instances.clear()
+
+
+def warm_up():
+    """
+    Builds the client and agents and reads the tables once, so the first real
+    request does not pay for it. Called from the gunicorn post_worker_init hook.
+    """
+    get_openai_client()
+    get_chat_agent()
+    get_product_description_agent()
+    get_comparison_agent()
+    get_preference_agent()
+    product_index.rebuild()
+    rows = 0
+    for load in (csv_db.load_users, csv_db.load_preferences, csv_db.load_shopping_sessions, csv_db.load_product_pages):
+        rows += len(load())
+    log.info("Warm-up complete", extra=fields(pid=os.getpid(), rows=rows))
+
+
+def _after_fork():
+    # A fresh lock in case another thread held it when the process forked.
+    global _lock
+    _lock = threading.Lock()
+    _instances.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,67 @@
+# single_flight.py
+import hashlib
+import threading
+from concurrent.futures import Future
+
+from scripts.logging_utils import get_logger, fields
+from scripts.metrics import Counter, register
+
+log = get_logger("single_flight")
+
+COALESCED_CALLS = register(Counter(
+    "coalesced_calls_total", "Calls answered from an identical in-flight call instead of running again, by endpoint.",
+    ("endpoint",),
+))
+
+
+def input_hash(text):
+    """
+    Short stable digest of a request input, for use in coalescing keys.
+    """
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()[:32]
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. While a call for a key is in
+    flight, identical calls wait for it and receive the same result (or the
+    same exception) instead of running themselves. Nothing is cached once the
+    call has finished.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> Future
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Returns func(*args, **kwargs), sharing the run with any concurrent
+        caller using the same key.
+
+        Args:
+            key (tuple): (endpoint, session_id, input hash); key[0] labels the metric.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+
+        if not leader:
+            COALESCED_CALLS.inc(endpoint=key[0])
+            log.info("Coalesced duplicate call", extra=fields(endpoint=key[0], session_id=key[1]))
+            return call.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+in_flight = SingleFlight()
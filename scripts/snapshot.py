@@ -0,0 +1,265 @@
+# snapshot.py
+"""
+Compact binary snapshots of the CSV tables.
+
+A snapshot stores a table column by column: every distinct string (user IDs,
+timestamps, preference keys, ...) is stored once in a string table, and each
+column is an array of 32-bit indices into it. Loading decodes the string table
+in one pass and shares one str object per distinct value, which is much faster
+and lighter than csv.DictReader.
+
+Layout of "<table>.csv.snap":
+    b"PPDSNAP1"
+    uint32 header length, JSON header:
+        {"fieldnames": [...], "rows": N, "strings": K, "source": {"size": ..., "mtime_ns": ...}}
+    uint32[K + 1] character offsets into the string blob
+    uint32        byte length of the string blob, then the UTF-8 blob
+    uint32[N] per field, in header order (MISSING marks an absent value)
+
+Usage:
+    python -m scripts.snapshot build                 # snapshot every table in DemoDatabase/
+    python -m scripts.snapshot export SNAP_FILE CSV_FILE
+"""
+import argparse
+import csv
+import json
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from itertools import islice, repeat
+
+MAGIC = b"PPDSNAP1"
+MISSING = 0xFFFFFFFF
+SUFFIX = ".snap"
+
+_U32 = struct.Struct("<I")
+
+
+def snapshot_path(csv_path):
+    return csv_path + SUFFIX
+
+
+def source_stamp(st):
+    """
+    Snapshot stamp of a CSV file from its os.stat()/os.fstat() result.
+    """
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _source_stamp(csv_path):
+    return source_stamp(os.stat(csv_path))
+
+
+def _u32_array(values):
+    arr = array("I", values)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+
+def _read_u32_array(data, offset, count):
+    arr = array("I")
+    arr.frombytes(data[offset:offset + 4 * count])
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr, offset + 4 * count
+
+
+# ------------------------------------------------------------------------------
+# 1. WRITE
+# ------------------------------------------------------------------------------
+def write_snapshot(snap_path, rows, fieldnames, source=None, restval=None):
+    """
+    Writes `rows` (list of dicts) as a columnar snapshot. `source` is the stat
+    stamp of the CSV it mirrors, used to detect stale snapshots. When `restval`
+    is given, absent and None values are stored as it, the way csv.DictWriter
+    writes them (so the snapshot matches what re-reading the CSV would give).
+    """
+    index_of = {}
+    strings = []
+    columns = []
+    for name in fieldnames:
+        column = []
+        for row in rows:
+            value = row.get(name)
+            if value is None and restval is not None:
+                value = restval
+            if value is None:
+                column.append(MISSING)
+                continue
+            value = str(value)
+            idx = index_of.get(value)
+            if idx is None:
+                idx = index_of[value] = len(strings)
+                strings.append(value)
+            column.append(idx)
+        columns.append(column)
+
+    offsets = [0]
+    for value in strings:
+        offsets.append(offsets[-1] + len(value))
+    blob = "".join(strings).encode("utf-8")
+
+    header = json.dumps({
+        "fieldnames": list(fieldnames),
+        "rows": len(rows),
+        "strings": len(strings),
+        "source": source,
+    }).encode("utf-8")
+
+    os.makedirs(os.path.dirname(snap_path) or ".", exist_ok=True)
+    # A unique temp file: a writer and a reader refreshing the same snapshot
+    # must not write into or rename each other's file.
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(snap_path) + ".", suffix=".tmp", dir=os.path.dirname(snap_path) or "."
+    )
+    try:
+        os.chmod(tmp_path, 0o644)
+        with open(fd, "wb") as f:
+            f.write(MAGIC)
+            f.write(_U32.pack(len(header)))
+            f.write(header)
+            _u32_array(offsets).tofile(f)
+            f.write(_U32.pack(len(blob)))
+            f.write(blob)
+            for column in columns:
+                _u32_array(column).tofile(f)
+        os.replace(tmp_path, snap_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_snapshot_for(csv_path, rows, fieldnames, source, restval=None):
+    """
+    Writes the snapshot mirroring `csv_path`. `source` is the stamp
+    (source_stamp) of the exact file version the rows came from, taken on the
+    open handle: stamping with a later os.stat(csv_path) would label old rows
+    with a newer file's stamp if the CSV was replaced in between.
+    """
+    write_snapshot(snapshot_path(csv_path), rows, fieldnames, source, restval)
+
+
+# ------------------------------------------------------------------------------
+# 2. READ
+# ------------------------------------------------------------------------------
+def read_columns(snap_path):
+    """
+    Returns (header, columns): the snapshot header and one list of values per
+    field. Values are shared str objects (interned per snapshot).
+    """
+    with open(snap_path, "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{snap_path} is not a snapshot file")
+    pos = len(MAGIC)
+    (header_len,) = _U32.unpack_from(data, pos)
+    pos += 4
+    header = json.loads(data[pos:pos + header_len])
+    pos += header_len
+
+    offsets, pos = _read_u32_array(data, pos, header["strings"] + 1)
+    (blob_len,) = _U32.unpack_from(data, pos)
+    pos += 4
+    text = data[pos:pos + blob_len].decode("utf-8")
+    pos += blob_len
+    strings = [text[start:end] for start, end in zip(offsets, islice(offsets, 1, None))]
+    strings_get = strings.__getitem__
+
+    columns = []
+    for _ in header["fieldnames"]:
+        indices, pos = _read_u32_array(data, pos, header["rows"])
+        if MISSING in indices:
+            columns.append([None if i == MISSING else strings_get(i) for i in indices])
+        else:
+            columns.append(list(map(strings_get, indices)))
+    return header, columns
+
+
+def _rows_from_columns(fieldnames, columns):
+    return list(map(dict, map(zip, repeat(fieldnames), zip(*columns))))
+
+
+def read_rows(snap_path):
+    """
+    Returns (fieldnames, rows) with rows as dicts, like csv.DictReader would.
+    """
+    header, columns = read_columns(snap_path)
+    return header["fieldnames"], _rows_from_columns(header["fieldnames"], columns)
+
+
+def load_if_fresh(csv_path):
+    """
+    Returns the rows of `csv_path` from its snapshot if the snapshot exists and
+    was written for the CSV's current size and mtime, else None.
+    """
+    snap_path = snapshot_path(csv_path)
+    try:
+        header, columns = read_columns(snap_path)
+        if header.get("source") != _source_stamp(csv_path):
+            return None
+    except (OSError, ValueError):
+        return None
+    return _rows_from_columns(header["fieldnames"], columns)
+
+
+# ------------------------------------------------------------------------------
+# 3. CSV EXPORT / BUILD
+# ------------------------------------------------------------------------------
+def export_csv(snap_path, csv_path):
+    """
+    Writes a snapshot back out in the regular CSV layout.
+    """
+    fieldnames, rows = read_rows(snap_path)
+    with open(csv_path, mode="w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+
+def build_all(root="DemoDatabase"):
+    """
+    (Re)builds the snapshot of every CSV file under `root`.
+    """
+    built = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            if not name.endswith(".csv"):
+                continue
+            path = os.path.join(dirpath, name)
+            with open(path, mode="r", encoding="utf-8") as f:
+                source = source_stamp(os.fstat(f.fileno()))
+                reader = csv.DictReader(f)
+                rows = list(reader)
+                fieldnames = reader.fieldnames or []
+            write_snapshot_for(path, rows, fieldnames, source)
+            built.append(path)
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or export binary table snapshots.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Snapshot every CSV table.")
+    build.add_argument("--root", default="DemoDatabase")
+    export = sub.add_parser("export", help="Convert a snapshot back to CSV.")
+    export.add_argument("snapshot")
+    export.add_argument("csv")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        for path in build_all(args.root):
+            print("Snapshot written for", path)
+    else:
+        count = export_csv(args.snapshot, args.csv)
+        print(f"Exported {count} rows to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
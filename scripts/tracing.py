@@ -0,0 +1,191 @@
+# tracing.py
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# When set, every finished trace is appended to this file as one JSON line.
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+# When "1", every response carries its trace in the X-Trace header. Otherwise the
+# header is only added for requests that send "X-Debug-Trace: 1".
+TRACE_HEADER = os.getenv("TRACE_HEADER", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+_current_trace = ContextVar("current_trace", default=None)
+_current_span = ContextVar("current_span", default=None)
+_trace_file_lock = threading.Lock()
+
+
+# ------------------------------------------------------------------------------
+# 1. TRACES AND SPANS
+# ------------------------------------------------------------------------------
+class Trace:
+    """
+    Collects the spans recorded while handling a single request.
+    """
+    def __init__(self, name):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def _new_span_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            "spans": sorted(self.spans, key=lambda s: s["start_ms"]),
+        }
+
+
+def start_trace(name):
+    """
+    Starts a trace for the current context and returns (trace, token).
+    Pass the token to finish_trace() when the request is done.
+    """
+    trace = Trace(name)
+    return trace, _current_trace.set(trace)
+
+
+def finish_trace(token):
+    """
+    Closes the trace started with `token` and detaches it from the context.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.duration = time.perf_counter() - trace.start
+    _current_trace.reset(token)
+    _current_span.set(None)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Records a nested span on the active trace. Does nothing (beyond a
+    ContextVar lookup) when no trace is active, e.g. in background threads.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    span_id = trace._new_span_id()
+    parent_id = _current_span.get()
+    token = _current_span.set(span_id)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        end = time.perf_counter()
+        _current_span.reset(token)
+        record = {
+            "id": span_id,
+            "parent": parent_id,
+            "name": name,
+            "start_ms": round((start - trace.start) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3),
+        }
+        if attrs:
+            record["attrs"] = attrs
+        if error:
+            record["error"] = error
+        with trace._lock:
+            trace.spans.append(record)
+
+
+def trace_header_value(trace):
+    return json.dumps(trace.to_dict(), separators=(",", ":"), default=str)
+
+
+def write_trace(trace):
+    """
+    Appends the trace to TRACE_FILE, if one is configured.
+    """
+    if not TRACE_FILE:
+        return
+    line = json.dumps(trace.to_dict(), default=str)
+    with _trace_file_lock:
+        with open(TRACE_FILE, mode="a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+# ------------------------------------------------------------------------------
+# 2. ON-DEMAND PROFILING
+# ------------------------------------------------------------------------------
+class ProfileSampler:
+    """
+    Profiles the next N requests to an endpoint with cProfile and dumps each
+    profile to PROFILE_DIR as a .prof file (readable with pstats or snakeviz).
+    Only one request is profiled at a time; concurrent requests are skipped.
+    """
+    def __init__(self, profile_dir=PROFILE_DIR):
+        self.profile_dir = profile_dir
+        self._lock = threading.Lock()
+        self._active = threading.Lock()
+        self._remaining = {}
+        self.dumps = []
+
+    def arm(self, endpoint, count):
+        with self._lock:
+            if count > 0:
+                self._remaining[endpoint] = count
+            else:
+                self._remaining.pop(endpoint, None)
+
+    def status(self):
+        with self._lock:
+            return {"armed": dict(self._remaining), "dumps": list(self.dumps)}
+
+    def start(self, endpoint):
+        """
+        Returns an enabled cProfile.Profile if this request should be sampled, else None.
+        """
+        with self._lock:
+            if self._remaining.get(endpoint, 0) <= 0:
+                return None
+            if not self._active.acquire(blocking=False):
+                return None
+            self._remaining[endpoint] -= 1
+            if self._remaining[endpoint] <= 0:
+                del self._remaining[endpoint]
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def stop(self, profiler, endpoint):
+        profiler.disable()
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            slug = re.sub(r"[^A-Za-z0-9]+", "_", endpoint).strip("_") or "root"
+            path = os.path.join(self.profile_dir, f"{slug}-{int(time.time() * 1000)}.prof")
+            profiler.dump_stats(path)
+        finally:
+            self._active.release()
+        with self._lock:
+            self.dumps.append(path)
+        return path
+
+
+profile_sampler = ProfileSampler()
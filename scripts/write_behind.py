@@ -0,0 +1,151 @@
+# write_behind.py
+import atexit
+import os
+import threading
+import time
+
+from scripts.logging_utils import get_logger, fields
+from scripts.metrics import Counter, register
+
+log = get_logger("write_behind")
+
+STORAGE_FLUSHES = register(Counter(
+    "storage_flushes_total", "Files written by the write-behind flusher, by table.",
+    ("table",),
+))
+STORAGE_COALESCED_WRITES = register(Counter(
+    "storage_coalesced_writes_total", "Table saves absorbed into a later write-behind flush, by table.",
+    ("table",),
+))
+
+
+class WriteBehindStore:
+    """
+    Keeps whole tables in memory and writes them to disk from a single flusher
+    thread. A save replaces the in-memory table immediately and marks the file
+    dirty; the flusher waits up to `flush_interval` seconds to collect more
+    saves, then writes the latest version of every dirty file once.
+
+    Args:
+        reader: reader(filepath, fieldnames) -> list of dicts, used on a cache miss.
+        writer: writer(filepath, rows, fieldnames, fsync) performing the disk write.
+        table_name: table_name(filepath) -> metrics label.
+        flush_interval (float): Upper bound, in seconds, on how long a save stays in memory only.
+        fsync (str): "always" fsyncs every flushed file, "shutdown" only on the
+                     final flush, "never" leaves it to the OS.
+    """
+    def __init__(self, reader, writer, table_name, flush_interval=0.5, fsync="never"):
+        self._reader = reader
+        self._writer = writer
+        self._table_name = table_name
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        self._lock = threading.Lock()
+        self._tables = {}         # filepath -> [rows, fieldnames]
+        self._dirty = {}          # filepath -> number of saves since the last flush
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        # Started on the first save, in the process doing the saving: a flusher
+        # started before a fork (gunicorn --preload) would not exist in the workers.
+        self._thread = None
+        self._thread_pid = None
+        atexit.register(self.close)
+
+    # --------------------------------------------------------------------------
+    # Reads and writes
+    # --------------------------------------------------------------------------
+    def _table(self, filepath, fieldnames=None):
+        with self._lock:
+            entry = self._tables.get(filepath)
+        if entry is None:
+            rows = self._reader(filepath, fieldnames)
+            with self._lock:
+                # Another thread may have loaded or saved it meanwhile; keep theirs.
+                entry = self._tables.setdefault(filepath, [rows, list(rows[0].keys()) if rows else None])
+        return entry
+
+    def load(self, filepath, fieldnames=None):
+        """
+        Returns copies of the rows, so callers can mutate them freely.
+        """
+        rows = self._table(filepath, fieldnames)[0]
+        return [dict(r) for r in rows]
+
+    def iter_rows(self, filepath):
+        for row in self._table(filepath)[0]:
+            yield dict(row)
+
+    def save(self, filepath, rows, fieldnames):
+        table = self._table_name(filepath)
+        with self._lock:
+            self._ensure_flusher()
+            self._tables[filepath] = [list(rows), list(fieldnames)]
+            pending = self._dirty.get(filepath, 0)
+            if pending:
+                STORAGE_COALESCED_WRITES.inc(table=table)
+            self._dirty[filepath] = pending + 1
+            self._wakeup.notify()
+
+    # --------------------------------------------------------------------------
+    # Flushing
+    # --------------------------------------------------------------------------
+    def _ensure_flusher(self):
+        # Caller holds self._lock.
+        if self._thread_pid != os.getpid() and not self._stopping:
+            self._thread = threading.Thread(target=self._run, name="ppd-csv-flusher", daemon=True)
+            self._thread_pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._dirty and not self._stopping:
+                    self._wakeup.wait()
+                if self._stopping:
+                    return
+            # Give concurrent saves a chance to coalesce into this batch.
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Write-behind flush failed; will retry")
+
+    def flush(self, final=False):
+        """
+        Writes every dirty table to disk now. Safe to call from any thread.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = [(path, self._tables[path][0], self._tables[path][1], count)
+                         for path, count in self._dirty.items()]
+                self._dirty = {}
+            fsync = self.fsync == "always" or (final and self.fsync == "shutdown")
+            for i, (path, rows, fieldnames, count) in enumerate(batch):
+                try:
+                    self._writer(path, rows, fieldnames, fsync)
+                except Exception:
+                    # Put the unwritten tables back so the next flush retries them.
+                    with self._lock:
+                        for retry_path, _, _, retry_count in batch[i:]:
+                            self._dirty[retry_path] = self._dirty.get(retry_path, 0) + retry_count
+                    raise
+                STORAGE_FLUSHES.inc(table=self._table_name(path))
+            if batch:
+                log.debug("Write-behind flush", extra=fields(
+                    files=len(batch), saves=sum(b[3] for b in batch)
+                ))
+
+    def close(self):
+        """
+        Stops the flusher thread and writes any pending tables.
+        """
+        with self._lock:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush(final=True)
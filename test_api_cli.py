@@ -3,6 +3,8 @@ import sys
 import os
 
 BASE_URL = "http://127.0.0.1:5000/api"
+# Shared HTTP session; after a successful login it carries the bearer token.
+http = requests.Session()
 
 def menu():
     print("\n=== API Test Menu ===")
@@ -27,7 +29,7 @@ def create_user_flow():
     password = input("Enter password: ")
 
     data = {"name": name, "email": email, "password": password}
-    resp = requests.post(f"{BASE_URL}/users", json=data)
+    resp = http.post(f"{BASE_URL}/users", json=data)
     if resp.status_code == 201:
         print("User created successfully!")
         print("Response:", resp.json())
@@ -37,7 +39,7 @@ def create_user_flow():
 def get_user_flow():
     print("\n--- Get User ---")
     user_id = input("Enter user_id: ")
-    resp = requests.get(f"{BASE_URL}/users/{user_id}")
+    resp = http.get(f"{BASE_URL}/users/{user_id}")
     if resp.status_code == 200:
         print("User found:")
         print(resp.json())
@@ -60,7 +62,7 @@ def update_user_preferences_flow():
         else:
             print("Invalid format. Use key=value or 'done' to finish.")
     data = {"preferences": prefs_list}
-    resp = requests.post(f"{BASE_URL}/users/{user_id}/preferences", json=data)
+    resp = http.post(f"{BASE_URL}/users/{user_id}/preferences", json=data)
     if resp.status_code == 200:
         print("Preferences updated.")
         print("Response:", resp.json())
@@ -70,7 +72,7 @@ def update_user_preferences_flow():
 def get_user_preferences_flow():
     print("\n--- Get User Preferences ---")
     user_id = input("Enter user_id: ")
-    resp = requests.get(f"{BASE_URL}/users/{user_id}/preferences")
+    resp = http.get(f"{BASE_URL}/users/{user_id}/preferences")
     if resp.status_code == 200:
         print("User preferences:")
         print(resp.json())
@@ -82,7 +84,7 @@ def create_shopping_session_flow():
     user_id = input("Enter user_id: ")
     intent = input("What is the user shopping for? (intent): ")
     data = {"intent": intent}
-    resp = requests.post(f"{BASE_URL}/users/{user_id}/shopping_sessions", json=data)
+    resp = http.post(f"{BASE_URL}/users/{user_id}/shopping_sessions", json=data)
     if resp.status_code == 201:
         print("Shopping session created.")
         print("Response:", resp.json())
@@ -92,7 +94,7 @@ def create_shopping_session_flow():
 def get_shopping_session_flow():
     print("\n--- Get Shopping Session ---")
     session_id = input("Enter session_id: ")
-    resp = requests.get(f"{BASE_URL}/shopping_sessions/{session_id}")
+    resp = http.get(f"{BASE_URL}/shopping_sessions/{session_id}")
     if resp.status_code == 200:
         print("Shopping session:")
         print(resp.json())
@@ -104,7 +106,7 @@ def add_chat_message_flow():
     session_id = input("Enter session_id: ")
     message = input("Enter your chat message: ")
     data = {"message": message}
-    resp = requests.post(f"{BASE_URL}/shopping_sessions/{session_id}/messages", json=data)
+    resp = http.post(f"{BASE_URL}/shopping_sessions/{session_id}/messages", json=data)
     if resp.status_code == 200:
         print("Chat updated. Latest messages in thread:")
         print(resp.json())
@@ -125,7 +127,7 @@ def generate_product_description_flow():
         print("Error reading file:", e)
         return
     data = {"product_page": product_page}
-    resp = requests.post(f"{BASE_URL}/shopping_sessions/{session_id}/product_description", json=data)
+    resp = http.post(f"{BASE_URL}/shopping_sessions/{session_id}/product_description", json=data)
     if resp.status_code == 200:
         print("Product description generated:")
         print(resp.json())
@@ -137,17 +139,18 @@ def login_flow():
     email = input("Enter email: ")
     password = input("Enter password: ")
     data = {"email": email, "password": password}
-    resp = requests.post(f"{BASE_URL}/login", json=data)
+    resp = http.post(f"{BASE_URL}/login", json=data)
     if resp.status_code == 200:
         print("Login successful!")
         print("Response:", resp.json())
+        http.headers["Authorization"] = f"Bearer {resp.json()['token']}"
     else:
         print("Error:", resp.status_code, resp.text)
 
 def get_user_sessions_flow():
     print("\n--- Get All Sessions for User ---")
     user_id = input("Enter user_id: ")
-    resp = requests.get(f"{BASE_URL}/users/{user_id}/sessions")
+    resp = http.get(f"{BASE_URL}/users/{user_id}/sessions")
     if resp.status_code == 200:
         print("User sessions:")
         print(resp.json())
@@ -157,7 +160,7 @@ def get_user_sessions_flow():
 def generate_product_comparison_flow():
     print("\n--- Generate Product Comparison ---")
     session_id = input("Enter session_id: ")
-    resp = requests.post(f"{BASE_URL}/shopping_sessions/{session_id}/product_comparison")
+    resp = http.post(f"{BASE_URL}/shopping_sessions/{session_id}/product_comparison")
     if resp.status_code == 200:
         print("Comparison results:")
         print(resp.json())
@@ -167,10 +170,13 @@ def generate_product_comparison_flow():
 def end_shopping_session_flow():
     print("\n--- End Shopping Session (Extract Preferences) ---")
     session_id = input("Enter session_id: ")
-    resp = requests.post(f"{BASE_URL}/shopping_sessions/{session_id}/end")
+    resp = http.post(f"{BASE_URL}/shopping_sessions/{session_id}/end")
     if resp.status_code == 200:
         print("Session ended and preferences updated:")
         print(resp.json())
+    elif resp.status_code == 202:
+        print("Session ended. Preferences are being extracted in the background:")
+        print(resp.json())
     else:
         print("Error:", resp.status_code, resp.text)
 
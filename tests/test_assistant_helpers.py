@@ -0,0 +1,22 @@
+from scripts.assistant_helpers import merge_preference
+
+
+def test_scalar_values_are_replaced():
+    assert merge_preference("Married", "Single", "Marital Status") == "Single"
+    assert merge_preference("", "Married", "Marital Status") == "Married"
+
+
+def test_values_with_thousands_separators_are_not_split():
+    assert merge_preference("$100-$200", "$1,000-$1,500", "Budget") == "$1,000-$1,500"
+    assert merge_preference("$1,000", "$2,500", "Budget") == "$2,500"
+    assert merge_preference("$1,000", "$2,500") == "$2,500"
+
+
+def test_list_keys_are_unioned():
+    merged = merge_preference("Digital Design, Baking", "baking,Travel Documentaries", "Interests")
+    assert merged == "Digital Design, Baking, Travel Documentaries"
+    assert merge_preference("Hiking", "Cooking", "interests") == "Hiking, Cooking"
+
+
+def test_stored_list_is_unioned_for_unknown_keys():
+    assert merge_preference("Nike, Adidas", "Puma", "Sneaker Brands") == "Nike, Adidas, Puma"
@@ -0,0 +1,71 @@
+import csv
+import os
+
+from scripts import csv_db, snapshot
+
+
+def _write_plain_csv(path, rows, fieldnames):
+    with open(path, mode="w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def test_round_trip(tmp_path):
+    csv_path = str(tmp_path / "users.csv")
+    rows = [
+        {"user_id": "1", "name": "Ana", "note": "café, ☕"},
+        {"user_id": "2", "name": "Ana", "note": ""},
+        {"user_id": "3", "name": "Bo"},  # absent value
+    ]
+    _write_plain_csv(csv_path, rows, ["user_id", "name", "note"])
+    source = snapshot.source_stamp(os.stat(csv_path))
+    snapshot.write_snapshot_for(csv_path, rows, ["user_id", "name", "note"], source)
+
+    fieldnames, loaded = snapshot.read_rows(snapshot.snapshot_path(csv_path))
+    assert fieldnames == ["user_id", "name", "note"]
+    # An absent value comes back as None, like csv.DictReader's short rows.
+    expected = rows[:2] + [{"user_id": "3", "name": "Bo", "note": None}]
+    assert loaded == expected
+    assert snapshot.load_if_fresh(csv_path) == expected
+
+    exported = str(tmp_path / "exported.csv")
+    assert snapshot.export_csv(snapshot.snapshot_path(csv_path), exported) == 3
+    with open(exported, encoding="utf-8") as f:
+        assert [r["note"] for r in csv.DictReader(f)] == ["café, ☕", "", ""]
+
+
+def test_snapshot_is_stale_after_csv_changes(tmp_path):
+    csv_path = str(tmp_path / "t.csv")
+    _write_plain_csv(csv_path, [{"a": "old"}], ["a"])
+    snapshot.write_snapshot_for(csv_path, [{"a": "old"}], ["a"], snapshot.source_stamp(os.stat(csv_path)))
+    assert snapshot.load_if_fresh(csv_path) == [{"a": "old"}]
+
+    _write_plain_csv(csv_path, [{"a": "newer"}], ["a"])
+    assert snapshot.load_if_fresh(csv_path) is None
+
+
+def test_refresh_racing_a_writer_does_not_serve_old_rows(tmp_path, monkeypatch):
+    csv_path = str(tmp_path / "t.csv")
+    _write_plain_csv(csv_path, [{"a": "old"}], ["a"])
+    monkeypatch.setattr(csv_db, "CSV_SNAPSHOTS", True)
+
+    # Replace the CSV after the reader has read it but before it refreshes the snapshot.
+    write_snapshot_for = snapshot.write_snapshot_for
+
+    def replace_then_write(path, rows, fieldnames, source, restval=None):
+        _write_plain_csv(csv_path, [{"a": "new"}], ["a"])
+        write_snapshot_for(path, rows, fieldnames, source, restval)
+
+    monkeypatch.setattr(snapshot, "write_snapshot_for", replace_then_write)
+    assert csv_db._read_csv(csv_path) == [{"a": "old"}]
+    monkeypatch.setattr(snapshot, "write_snapshot_for", write_snapshot_for)
+
+    assert csv_db._read_csv(csv_path) == [{"a": "new"}]
+
+
+def test_table_write_stamps_the_new_file(tmp_path, monkeypatch):
+    csv_path = str(tmp_path / "t.csv")
+    monkeypatch.setattr(csv_db, "CSV_SNAPSHOTS", True)
+    csv_db._write_csv(csv_path, [{"a": "1", "b": None}], ["a", "b"])
+    assert snapshot.load_if_fresh(csv_path) == [{"a": "1", "b": ""}]